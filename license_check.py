@@ -2,7 +2,7 @@
 #
 # MIT License
 #
-# (C) Copyright 2021-2025 Hewlett Packard Enterprise Development LP
+# (C) Copyright 2021-2026 Hewlett Packard Enterprise Development LP
 #
 # Permission is hereby granted, free of charge, to any person obtaining a
 # copy of this software and associated documentation files (the "Software"),
@@ -24,24 +24,719 @@
 #
 import argparse
 import re
-import yaml
 import sys
 import os
 import fnmatch
 import logging
 import datetime
+import hashlib
+import json
+import time
+import collections
+import heapq
+import stat
+import io
+import errno
+import codecs
+import contextlib
+import threading
+import copy
+import enum
+# Modules needed only in some modes (git, parallel workers, read ahead, diff, server, watch) are imported where they are used,
+# as importing all of them takes a noticeable part of startup time of a single file check
+
+# Checker instance used by worker processes of a parallel scan, set once per worker by init_worker()
+worker_license_check = None
+
+# Version of results files written by --results-out
+results_version = 1
+
+def init_worker(license_check):
+    global worker_license_check
+    worker_license_check = license_check
+    if license_check.stats:
+        # Statistics collected by the parent process so far are already accounted there
+        license_check.stats.drain()
+
+def check_file_worker(task):
+    filename, relpath, fix, prefetched = task
+    result, cache_update = worker_license_check.check_target(filename, fix, relpath, prefetched)
+    return result, cache_update, worker_license_check.stats.drain() if worker_license_check.stats else None
+
+"""
+Reads blobs from git object database through a single long-lived "git cat-file --batch" process, started on first read.
+Each process using the reader (i.e. each worker of a parallel scan) starts its own.
+"""
+class GitBlobReader(object):
+
+    def __init__(self):
+        self.process = None
+        # Blobs requested ahead by prefetch(), in order of requests
+        self.pending = None
+
+    def start(self):
+        import subprocess
+        if self.process is None:
+            try:
+                self.process = subprocess.Popen(["git", "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            except OSError as e:
+                raise ValueError("Can't run git: %s" % e)
+
+    """
+    Requests given blobs ahead, from a background thread, so that git streams blobs while previous ones are being
+    checked, instead of waiting for a round trip per blob. Blobs must then be read in the same order; blobs which are not
+    read are skipped.
+    """
+    def prefetch(self, blobs):
+        self.start()
+        self.pending = collections.deque(blobs)
+        threading.Thread(target=self.write_requests, args=(self.process.stdin, list(blobs)), daemon=True).start()
+
+    @staticmethod
+    def write_requests(stdin, blobs):
+        try:
+            for blob in blobs:
+                stdin.write(blob.encode() + b"\n")
+            stdin.close()
+        except (OSError, ValueError):
+            # Reader was closed before all blobs were requested
+            pass
+
+    def read(self, blob):
+        if self.pending is None:
+            self.start()
+            self.process.stdin.write(blob.encode() + b"\n")
+            self.process.stdin.flush()
+        else:
+            while self.pending and self.pending[0] != blob:
+                self.read_reply(self.pending.popleft())
+            if not self.pending:
+                raise ValueError("Git blob %s was not requested ahead" % blob)
+            self.pending.popleft()
+        return self.read_reply(blob)
+
+    def read_reply(self, blob):
+        # Reply is "<sha> blob <size>\n<content>\n", or "<sha> missing\n"
+        reply = self.process.stdout.readline().split()
+        if len(reply) != 3 or reply[1] != b"blob":
+            raise ValueError("Can't read git blob %s" % blob)
+        content = self.process.stdout.read(int(reply[2]))
+        self.process.stdout.read(1)
+        return content
+
+    def close(self):
+        if self.process is not None:
+            if self.pending is not None:
+                # Replies to requests made ahead may be left unread
+                self.process.kill()
+            else:
+                self.process.stdin.close()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+            self.pending = None
+
+    # Process handles can't be pickled and must not be shared with worker processes
+    def __getstate__(self):
+        return {"process": None, "pending": None}
+
+"""
+Set of fnmatch patterns, compiled for matching a path against all of them at once. Patterns without wildcards are looked
+up in a dict, patterns like '*.md' or '*/vendor' (a single leading wildcard followed by literal text) are looked up by
+extension or by suffix, and the remaining patterns are combined into a single regex. Order of patterns is preserved:
+first_match() returns index of the first pattern matching the path, same as looping over patterns with fnmatch.fnmatch().
+"""
+class FnmatchSet(object):
+
+    wildcards = re.compile(r'[*?\[]')
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.literals = {}
+        self.extensions = {}
+        self.suffixes = {}
+        regex_parts = []
+        for index, pattern in enumerate(self.patterns):
+            if not self.wildcards.search(pattern):
+                self.literals.setdefault(os.path.normcase(pattern), index)
+            elif pattern.startswith("*") and len(pattern) > 1 and not self.wildcards.search(pattern[1:]):
+                suffix = os.path.normcase(pattern[1:])
+                if suffix.startswith(".") and "." not in suffix[1:] and "/" not in suffix:
+                    self.extensions.setdefault(suffix, index)
+                else:
+                    self.suffixes.setdefault(suffix, index)
+            else:
+                regex_parts.append("(?P<p%d>%s)" % (index, fnmatch.translate(pattern)))
+        self.suffix_lengths = sorted(set(map(len, self.suffixes)))
+        self.regex = re.compile("|".join(regex_parts)) if regex_parts else None
+
+    def first_match(self, path):
+        path = os.path.normcase(path)
+        index = self.literals.get(path)
+        if self.extensions:
+            dot = path.rfind(".")
+            if dot >= 0:
+                extension_index = self.extensions.get(path[dot:])
+                if extension_index is not None and (index is None or extension_index < index):
+                    index = extension_index
+        for length in self.suffix_lengths:
+            if length > len(path):
+                break
+            suffix_index = self.suffixes.get(path[-length:])
+            if suffix_index is not None and (index is None or suffix_index < index):
+                index = suffix_index
+        if self.regex:
+            match = self.regex.match(path)
+            if match:
+                regex_index = int(match.lastgroup[1:])
+                if index is None or regex_index < index:
+                    index = regex_index
+        return index
+
+"""
+Patterns of a single .gitignore file, following git semantics: patterns containing a slash are anchored to the folder
+of .gitignore file, others match name at any level below it; trailing slash makes pattern match folders only; "**"
+matches any number of folders; "!" negates pattern; the last matching pattern wins. All patterns are combined into
+a single regex in reverse order, so the first matching alternative is the last matching pattern.
+"""
+class GitIgnore(object):
+
+    def __init__(self, lines):
+        dir_patterns = []
+        file_patterns = []
+        for index, line in enumerate(lines):
+            line = line.rstrip("\r\n")
+            while line.endswith(" ") and not line.endswith("\\ "):
+                line = line[:-1]
+            if not line or line.startswith("#"):
+                continue
+            group = "i%d" % index
+            if line.startswith("!"):
+                group = "n%d" % index
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            pattern = self.translate(line[1:] if line.startswith("/") else line)
+            if "/" not in line:
+                pattern = "(?:.*/)?" + pattern
+            pattern = "(?P<%s>%s)" % (group, pattern)
+            dir_patterns.insert(0, pattern)
+            if not dir_only:
+                file_patterns.insert(0, pattern)
+        self.dirs = re.compile("|".join(dir_patterns), re.DOTALL) if dir_patterns else None
+        self.files = re.compile("|".join(file_patterns), re.DOTALL) if file_patterns else None
+
+    @staticmethod
+    def translate(pattern):
+        result = ""
+        i = 0
+        n = len(pattern)
+        while i < n:
+            c = pattern[i]
+            i += 1
+            if c == "*":
+                if pattern[i:i + 1] == "*" and (i == 1 or pattern[i - 2] == "/") and (i + 1 == n or pattern[i + 1] == "/"):
+                    # "**" as a whole path component: "**/" matches zero or more folders, trailing "/**" - everything inside
+                    result += ".*" if i + 1 == n else "(?:.*/)?"
+                    i += 2
+                else:
+                    result += "[^/]*"
+            elif c == "?":
+                result += "[^/]"
+            elif c == "[":
+                end = pattern.find("]", i + 1 if pattern[i:i + 1] in ["!", "^", "]"] else i)
+                if end < 0:
+                    result += "\\["
+                else:
+                    chars = pattern[i:end].replace("\\", "\\\\")
+                    if chars[:1] in ["!", "^"]:
+                        chars = "^" + chars[1:]
+                    result += "[" + chars + "]"
+                    i = end + 1
+            elif c == "\\" and i < n:
+                result += re.escape(pattern[i])
+                i += 1
+            else:
+                result += re.escape(c)
+        return result
+
+    """
+    Returns True if path (relative to folder of .gitignore file) is ignored, False if it is explicitly re-included with
+    negated pattern, or None if no pattern matches.
+    """
+    def match(self, relpath, is_dir):
+        pattern = self.dirs if is_dir else self.files
+        if pattern is None:
+            return None
+        m = pattern.fullmatch(relpath)
+        if not m:
+            return None
+        return m.lastgroup[0] == "i"
+
+"""
+Result of HeaderParser.search(), providing the subset of re.Match interface used by the license checker.
+"""
+class HeaderMatch(object):
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    def group(self, name):
+        return self.groups[name]
+
+    def groupdict(self):
+        return self.groups
+
+"""
+Line based license header parser, alternative to regex built by LicenseCheck.template_to_pattern() (selected with
+'engine: parser'). Recognizes the same header layout: optional shebang, blank lines, insert_before, prefix-only lines,
+template lines (each with line_prefix, blank lines in between are allowed), prefix-only lines and insert_after. Template
+lines are compared one by one with normalized content lines, so matching time is linear in header window size, no matter
+how many blank or prefix-only lines the file has. Only template lines with [year] and [owner] placeholders use regex,
+limited to a single line.
+"""
+class HeaderParser(object):
+
+    def __init__(self, template, type_def):
+        self.pattern = "<parser for %s>" % template.strip().split("\n")[0]
+        self.shebang = re.compile(type_def["shebang_pattern"])
+        self.insert_before = re.compile(type_def["insert_before_pattern"] if "insert_before_pattern" in type_def else re.escape(type_def["insert_before"]))
+        self.insert_after = re.compile(type_def["insert_after_pattern"] if "insert_after_pattern" in type_def else re.escape(type_def["insert_after"]))
+        self.line_prefix = re.compile(LicenseCheck.line_prefix_pattern(type_def))
+        self.prefix_only_line = re.compile("(?:" + LicenseCheck.line_prefix_pattern(type_def) + ")? *$")
+        self.prefix_lines = re.compile("(?:" + LicenseCheck.line_prefix_pattern(type_def) + "\n)*")
+        self.group_names = ["shebang", "license"]
+        # Each template line is either None (empty line), plain string, or compiled regex if it has placeholders
+        self.lines = []
+        for line in template.strip().split("\n"):
+            line = line.rstrip(" ")
+            if not line:
+                self.lines.append(None)
+            elif "[year]" in line or "[owner]" in line:
+                self.lines.append(re.compile(re.escape(line)
+                    .replace(r'\[year\]', LicenseCheck.year_pattern)
+                    .replace(r'\[owner\]', LicenseCheck.owner_pattern) + " *"))
+                self.group_names.extend(self.lines[-1].groupindex)
+            else:
+                self.lines.append(line)
+
+    def search(self, content):
+        groups = dict.fromkeys(self.group_names)
+        match = self.shebang.match(content)
+        pos = match.end() if match else 0
+        groups["shebang"] = match.group(0) if match else None
+        end = self.parse_license(content, pos, groups)
+        if end is None:
+            groups = dict.fromkeys(self.group_names)
+            groups["shebang"] = match.group(0) if match else None
+        else:
+            groups["license"] = content[pos:end]
+        return HeaderMatch(groups)
+
+    """
+    Matches license at given position, storing placeholder values in groups. Returns position after the license or None.
+    """
+    def parse_license(self, content, pos, groups):
+        pos = self.skip_newlines(content, pos)
+        match = self.insert_before.match(content, pos)
+        if not match:
+            return None
+        pos = self.prefix_lines.match(content, match.end()).end()
+        for index, template_line in enumerate(self.lines):
+            if index > 0:
+                pos = self.skip_newlines(content, pos)
+            eol = content.find("\n", pos)
+            if eol < 0:
+                eol = len(content)
+            line = content[pos:eol]
+            if template_line is None:
+                if self.prefix_only_line.match(line):
+                    pos = eol
+                continue
+            match = self.line_prefix.match(line)
+            if not match:
+                return None
+            text = line[match.end():]
+            if isinstance(template_line, str):
+                if text.rstrip(" ") != template_line:
+                    return None
+            else:
+                match = template_line.fullmatch(text)
+                if not match:
+                    return None
+                groups.update(match.groupdict())
+            pos = eol
+        pos = self.skip_newlines(content, pos)
+        match = self.insert_after.match(content, self.prefix_lines.match(content, pos).end())
+        if match:
+            return match.end()
+        # Prefix-only lines are consumed greedily, if insert_after doesn't match after them, try to give some back
+        for pos in reversed(self.skip_prefix_lines(content, pos)):
+            match = self.insert_after.match(content, pos)
+            if match:
+                return match.end()
+        return None
+
+    newlines = re.compile("\n*")
+
+    def skip_newlines(self, content, pos):
+        return self.newlines.match(content, pos).end()
+
+    """
+    Returns list of positions after each of consecutive lines, consisting of line prefix only, starting with given position.
+    """
+    def skip_prefix_lines(self, content, pos):
+        positions = [pos]
+        while True:
+            match = self.line_prefix.match(content, pos)
+            if not match or not content.startswith("\n", match.end()):
+                return positions
+            pos = match.end() + 1
+            positions.append(pos)
+
+"""
+Low overhead scan statistics: cumulative time per phase, event counters, number of files per comment type and the
+slowest files. Collected only if enabled (LicenseCheck.stats is None otherwise). Worker processes send their statistics
+to the parent with each result, as returned by drain().
+"""
+class ScanStats(object):
+
+    phase_names = ["walk", "exclude", "file type", "read", "main pattern", "alternative pattern", "additional pattern", "fix"]
+
+    def __init__(self, top=10):
+        self.started = time.perf_counter()
+        self.top = top
+        self.phases = collections.Counter()
+        self.counters = collections.Counter()
+        self.file_types = collections.Counter()
+        self.files = 0
+        self.slowest = []
+
+    def add(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    def count(self, name):
+        self.counters[name] += 1
+
+    def add_file(self, filename, file_type, seconds):
+        self.files += 1
+        if file_type:
+            self.file_types[file_type] += 1
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, (seconds, filename))
+        elif self.slowest and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, filename))
+
+    """
+    Times iteration over given iterable, i.e. directory walk generator, as given phase.
+    """
+    def timed_iter(self, iterable, phase):
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(phase, time.perf_counter() - started)
+                return
+            self.add(phase, time.perf_counter() - started)
+            yield item
+
+    def drain(self):
+        delta = (self.phases, self.counters, self.file_types, self.files, self.slowest)
+        self.phases = collections.Counter()
+        self.counters = collections.Counter()
+        self.file_types = collections.Counter()
+        self.files = 0
+        self.slowest = []
+        return delta
+
+    def merge(self, delta):
+        phases, counters, file_types, files, slowest = delta
+        self.phases.update(phases)
+        self.counters.update(counters)
+        self.file_types.update(file_types)
+        self.files += files
+        for seconds, filename in slowest:
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, (seconds, filename))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, filename))
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        phases = dict(self.phases)
+        # Exclusion checks are performed while walking, report walk time without them
+        if "walk" in phases:
+            phases["walk"] = max(0.0, phases["walk"] - phases.get("exclude", 0.0))
+        exclusion_lookups = self.counters["exclusion cache hits"] + self.counters["exclusion cache misses"]
+        return {
+            "elapsed": elapsed,
+            "files": self.files,
+            "files_per_second": self.files / elapsed if elapsed > 0 else 0.0,
+            "phases": {name: phases.get(name, 0.0) for name in self.phase_names},
+            "file_types": dict(self.file_types.most_common()),
+            "counters": dict(sorted(self.counters.items())),
+            "exclusion_cache_hit_rate": self.counters["exclusion cache hits"] / exclusion_lookups if exclusion_lookups else 0.0,
+            "slowest_files": [{"file": filename, "seconds": seconds} for seconds, filename in sorted(self.slowest, reverse=True)],
+        }
+
+    def format_report(self):
+        report = self.report()
+        lines = ["Scan statistics:",
+            "  %d files checked in %.3f s (%.1f files/s)" % (report["files"], report["elapsed"], report["files_per_second"]),
+            "  Time per phase (cumulative over all worker processes):"]
+        for name, seconds in report["phases"].items():
+            lines.append("    %-20s %10.3f s" % (name, seconds))
+        lines.append("  Files per comment type:")
+        for name, count in report["file_types"].items():
+            lines.append("    %-20s %10d" % (name, count))
+        lines.append("  Counters:")
+        for name, count in report["counters"].items():
+            lines.append("    %-30s %10d" % (name, count))
+        lines.append("  Exclusion cache hit rate: %.1f%%" % (100.0 * report["exclusion_cache_hit_rate"]))
+        lines.append("  Slowest files:")
+        for entry in report["slowest_files"]:
+            lines.append("    %10.6f s  %s" % (entry["seconds"], entry["file"]))
+        return "\n".join(lines) + "\n"
+
+"""
+Outcome of checking a single file, with its result code (0 for files passing the check, 1 for files failing it, -1 for
+files which are not checked) and message, where "%s" is replaced with file name.
+"""
+class CheckStatus(enum.IntEnum):
+
+    UP_TO_DATE = (0, 0, "License is up to date: %s")
+    OLD_YEAR = (1, 1, "License is detected, but copyright year is not up to date: %s")
+    WRONG_OWNER = (2, 1, "License is detected, but copyright owner is not current: %s")
+    WRONG_WORDING = (3, 1, "License is detected, but wording is wrong: %s")
+    NOT_DETECTED = (4, 1, "License is not detected: %s")
+    NOT_RECOGNIZED = (5, 0, "Filename pattern not recognized: %s")
+    EMPTY = (6, 0, "File %s is empty")
+    BINARY = (7, -1, "Skipping binary file: %s")
+    UTF16 = (8, -1, "Skipping UTF-16 encoded file: %s")
+    UTF32 = (9, -1, "Skipping UTF-32 encoded file: %s")
+
+    def __new__(cls, value, code, message):
+        status = int.__new__(cls, value)
+        status._value_ = value
+        status.code = code
+        status.message = message
+        return status
+
+"""
+Counts of check results by status, per folder and per comment type, so that the outcome of a large scan can be reported
+without keeping its results.
+"""
+class ResultSummary(object):
+
+    def __init__(self):
+        self.by_directory = collections.defaultdict(collections.Counter)
+        self.by_type = collections.defaultdict(collections.Counter)
+
+    def add(self, result):
+        self.by_directory[os.path.dirname(result.path)][result.status] += 1
+        self.by_type[result.file_type][result.status] += 1
+
+    """
+    Subtracts result added before, when its file is checked again or removed (see --watch)
+    """
+    def remove(self, result):
+        for counts_by, key in ((self.by_directory, os.path.dirname(result.path)), (self.by_type, result.file_type)):
+            counts = counts_by[key]
+            counts[result.status] -= 1
+            if counts[result.status] <= 0:
+                del counts[result.status]
+            if not counts:
+                del counts_by[key]
+
+    """
+    Returns (number of files passing the check, number of checked files), skipped files are not counted
+    """
+    def score(self):
+        success = 0
+        total = 0
+        for counts in self.by_type.values():
+            for status, count in counts.items():
+                if status.code >= 0:
+                    total += count
+                    success += count if status.code == 0 else 0
+        return success, total
+
+    def report(self):
+        def named(counts):
+            return {status.name.lower(): count for status, count in sorted(counts.items())}
+        return {
+            "types": {file_type or "": named(counts) for file_type, counts in sorted(self.by_type.items(), key=lambda x: x[0] or "")},
+            "directories": {directory or os.path.curdir: named(counts) for directory, counts in sorted(self.by_directory.items())},
+        }
+
+    """
+    Adds counts of a report (see report()), i.e. one read from results file of a shard
+    """
+    def merge_report(self, report):
+        for file_type, counts in report["types"].items():
+            for name, count in counts.items():
+                self.by_type[file_type or None][CheckStatus[name.upper()]] += count
+        for directory, counts in report["directories"].items():
+            for name, count in counts.items():
+                self.by_directory[directory][CheckStatus[name.upper()]] += count
+
+    def format_report(self, top=10):
+        lines = ["Results per comment type:"]
+        for file_type, counts in sorted(self.by_type.items(), key=lambda x: x[0] or ""):
+            lines.append("    %-20s %s" % (file_type or "(not recognized)", ", ".join("%s %d" % (status.name.lower(), count)
+                for status, count in sorted(counts.items()))))
+        failing = [(sum(count for status, count in counts.items() if status.code > 0), directory)
+            for directory, counts in self.by_directory.items()]
+        lines.append("Folders with most files failing the check:")
+        for count, directory in heapq.nlargest(top, [x for x in failing if x[0]]):
+            lines.append("    %10d  %s" % (count, directory or os.path.curdir))
+        return "\n".join(lines) + "\n"
+
+"""
+Persistent cache of check results between runs. Entries are keyed by relative path and hold
+[size, mtime_ns, header_hash, status, last_used], where status is the value of CheckStatus.
+Whole cache is dropped if fingerprint of the effective configuration changes.
+"""
+class ResultCache(object):
+
+    version = 3
+    # Files modified less than this many seconds before the run are not trusted by stat alone
+    racy_window = 2
+
+    def __init__(self, cache_file, fingerprint, max_entries):
+        self.cache_file = cache_file
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.entries = {}
+        self.start_run()
+        try:
+            with open(cache_file) as f:
+                data = json.load(f)
+            if data.get("version") == self.version and data.get("fingerprint") == fingerprint:
+                self.entries = data["entries"]
+                logging.info("Loaded %d cached results from %s" % (len(self.entries), cache_file))
+            else:
+                logging.info("Discarding cache %s, configuration has changed" % cache_file)
+        except FileNotFoundError:
+            logging.info("Cache file %s does not exist yet" % cache_file)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning("Discarding unreadable cache file %s: %s" % (cache_file, e))
+
+    """
+    Starts a new run with entries loaded so far, so the cache can be kept in memory between runs (see --serve)
+    """
+    def start_run(self):
+        self.run_started = int(time.time())
+        self.used = set()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, entry):
+        entry[4] = self.run_started
+        self.entries[key] = entry
+        self.used.add(key)
+
+    def new_entry(self, file_stat, header_hash, status):
+        # Don't trust mtime of files which might still be written within the same timestamp tick
+        mtime_ns = file_stat.st_mtime_ns if file_stat.st_mtime_ns // 1000000000 < self.run_started - self.racy_window else 0
+        return [file_stat.st_size, mtime_ns, header_hash, int(status), self.run_started]
+
+    """
+    Writes cache back to disk, dropping least recently used entries not seen in this run if cache grows above max_entries.
+    """
+    def save(self):
+        if len(self.entries) > self.max_entries:
+            stale = sorted((k for k in self.entries if k not in self.used), key=lambda k: self.entries[k][4])
+            for key in stale[:len(self.entries) - self.max_entries]:
+                del self.entries[key]
+        tmp_file = self.cache_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump({"version": self.version, "fingerprint": self.fingerprint, "entries": self.entries}, f, separators=(",", ":"))
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            logging.warning("Can't write cache file %s: %s" % (self.cache_file, e))
 
 class LicenseCheck(object):
 
+    # Number of files handed over to a worker process at once in parallel mode
+    worker_chunksize = 16
+    # Regex fragments replacing [year] and [owner] placeholders of license templates
+    year_pattern = r'\[?(?P<start_year>[0-9\- ,]*)(?P<end_year>[0-9]{4})\]?'
+    owner_pattern = r'(?P<owner>[a-zA-Z0-9 \-,/]+)'
+    # Minimum length of text common to all license templates, to be used to quickly filter out files without license
+    min_needle_length = 4
+    # Maximum number of paths with cached exclusion check result
+    exclusion_cache_size = 65536
+    # Bytes added to the length of rendered license header in initial header window, to fit shebang line, longer list of
+    # years or owner name. Same slack is kept after the header, when header window is extended.
+    header_window_slack = 256
+    # Byte order marks of encodings, which can't be checked or fixed byte-compatibly with ASCII license template
+    unsupported_boms = [(codecs.BOM_UTF32_LE, CheckStatus.UTF32), (codecs.BOM_UTF32_BE, CheckStatus.UTF32), (codecs.BOM_UTF16_LE, CheckStatus.UTF16), (codecs.BOM_UTF16_BE, CheckStatus.UTF16)]
+    # Number of threads writing files when applying a patch, and number of files handed to a thread at once
+    apply_threads = 16
+    apply_batch_size = 64
+    # Maximum number of bytes copied by a single system call, when copying the rest of a file on fix
+    copy_chunk_size = 1 << 30
+    # File where effective configuration and pattern sources are cached between runs. It is kept in the folder of cache_file
+    # given as argument, or in current directory, as cache_file of configuration files is not known before they are parsed.
+    config_cache_name = ".license_check.config.cache"
+    # Maximum number of cached configurations (distinct configuration file contents and arguments)
+    config_cache_entries = 8
+    # Name of configuration files, merged over configuration of parent folder for files of their folder and subfolders
+    nested_config_name = ".license_check.yaml"
+    # Configuration keys which compiled patterns, file type dispatch table and header windows depend on. Nested scopes
+    # with the same values share them.
+    compiled_config_keys = ["license_template", "additional_templates", "comment_types", "file_types", "owner", "engine",
+        "encoding", "header_window_max"]
+    # Configuration keys affecting check results. Cached results are discarded if any of these change.
+    cache_fingerprint_keys = ["license_template", "additional_templates", "comment_types", "file_types", "owner", "end_year", "ignore_year", "engine", "encoding", "header_window_max"]
+
+    """
+    Result of checking a file. Large scans keep many results, so only status, path, comment type and year and owner
+    groups of the match are kept: match objects refer to the whole header text. Values repeated across files are
+    interned, message is made on demand.
+    """
     class LicenseCheckResult(object):
-        def __init__(self, code, message, matcher=None):
-            self.code = code
-            self.message = message
-            self.matcher = matcher
-            if code > 0:
-                logging.warning(message)
+
+        __slots__ = ["status", "path", "file_type", "start_year", "end_year", "owner", "patch"]
+
+        def __init__(self, status, path, file_type=None, matcher=None, patch=None):
+            self.status = status
+            self.path = sys.intern(path)
+            self.file_type = file_type
+            groups = matcher.groupdict() if matcher else {}
+            self.start_year = groups.get("start_year")
+            self.end_year = sys.intern(groups["end_year"]) if groups.get("end_year") else groups.get("end_year")
+            self.owner = sys.intern(groups["owner"]) if groups.get("owner") else groups.get("owner")
+            # Unified diff of planned header rewrite, in diff mode
+            self.patch = patch
+
+        @property
+        def code(self):
+            return self.status.code
+
+        @property
+        def message(self):
+            return self.status.message % self.path
+
+        # Year and owner groups of the match, if license was detected
+        @property
+        def matcher(self):
+            if self.end_year is None and self.owner is None:
+                return None
+            return HeaderMatch({"start_year": self.start_year, "end_year": self.end_year, "owner": self.owner})
+
+        def log(self):
+            if self.code > 0:
+                logging.warning(self.message)
             else:
-                logging.info(message)
+                logging.info(self.message)
 
         def __repr__(self):
             return "[%d, %s]" % (self.code, self.message)
@@ -56,41 +751,261 @@ class LicenseCheck(object):
         return result
 
     def __init__(self, **kwargs):
-        self.config = self.read_config(sys.path[0] + os.path.sep + 'license_check.yaml')
         config_override = kwargs.get("config_override")
         if not config_override:
             config_override = os.getcwd() + os.path.sep + ".license_check.yaml"
+        # Configuration files this instance was built from, whether they exist or not
+        self.config_files = [os.path.abspath(sys.path[0] + os.path.sep + 'license_check.yaml'), os.path.abspath(config_override)]
+        # Effective configuration is cached together with persistent result cache, see load_cached_config()
+        self.config_cache_file = os.path.join(os.path.dirname(kwargs.get("cache_file") or ""), self.config_cache_name)
+        self.cached_config_key = self.config_cache_key(kwargs) if kwargs.get("cache") else None
+        cached = self.load_cached_config(self.cached_config_key) if self.cached_config_key else None
+        if cached:
+            self.config = cached["config"]
+        else:
+            self.config = self.build_config(config_override, kwargs)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            import yaml
+            logging.debug("Effective configuration:\n" + yaml.safe_dump(self.config))
+        self.config["engine"] = self.config["engine"] if self.config.get("engine") else "regex"
+        if self.config["engine"] not in ["regex", "parser"]:
+            raise ValueError("Unknown matching engine %s, must be one of: regex, parser" % self.config["engine"])
+        self.init_compiled_state(cached)
+        # Pattern sources are built on first use of a file type, and added to cached configuration after the scan
+        self.cached_sources_count = len(self.combined_sources) if cached else -1
+        self.save_combined_sources()
+        # Compile exclusion patterns and cache exclusion computations for most recently checked paths
+        self.exclude_patterns = FnmatchSet(self.config["exclude"])
+        self.exclusion_cache = collections.OrderedDict()
+        self.gitignore_cache = {}
+        # Folders walked, as (path, relative path prefix), recorded only when set to a list (see --watch)
+        self.walked_directories = None
+        # Checkers of folders with nested configuration files, see config_scope(). Top level checker has no parent scope.
+        self.parent = None
+        self.scope_prefix = ""
+        self.cache_key_prefix = ""
+        self.init_file_types()
+        self.scopes = {}
+        self.compiled_scopes = {self.compiled_config_key(self.config): self}
+        # In staged mode, git blobs to read instead of files in working tree, and files to stage again after fix
+        self.staged_blobs = {}
+        self.restage_paths = []
+        self.blob_reader = GitBlobReader()
+        # Content of the last blob read, as blobs can be read only once, but header may be read again in a larger window
+        self.last_blob = (None, None)
+        self.stats = ScanStats(self.config.get("stats_top") or 10) if self.config.get("stats") else None
+        self.summary = ResultSummary()
+        self.result_cache = None
+        self.fingerprint = self.results_fingerprint(self.config)
+        if self.config.get("cache"):
+            self.result_cache = ResultCache(self.config["cache_file"], self.fingerprint, self.config["cache_max_entries"])
+        # Cache files are written into current folder, normally the scanned tree, and are never checked themselves
+        self.cache_relpaths = set(os.path.relpath(path) for cache_file in filter(None, [self.config.get("cache_file"), self.config_cache_file])
+            for path in [cache_file, cache_file + ".tmp"])
+
+    """
+    Sets up state derived from configuration: encoding, patterns (compiled on first use of a comment type), license
+    needles, header windows and file type dispatch table, taking pattern sources and needles from cached configuration
+    if given. The same state is shared by nested scopes with the same configuration, see share_compiled_state().
+    """
+    def init_compiled_state(self, cached=None):
+        state = {}
+        # Undecodable bytes are kept as surrogates, so they never fail the check and are written back unchanged on fix
+        state["encoding"] = codecs.lookup(self.config.get("encoding") or "utf-8").name
+        state["bom"] = codecs.BOM_UTF8 if state["encoding"] == "utf-8" else b""
+        # Patterns are compiled on first use of a comment type, see license_patterns() and shebang_pattern()
+        state["license_pattern_by_type"] = {}
+        state["shebang_pattern_by_type"] = {}
+        state["combined_pattern_by_type"] = {}
+        if cached:
+            state["combined_sources"] = cached["combined"]
+            state["license_needles"] = cached["needles"]
+        else:
+            state["combined_sources"] = {}
+            state["license_needles"] = self.find_license_needles([self.config["license_template"]] + self.config["additional_templates"])
+        state["license_needle_bytes"] = [needle.encode(state["encoding"], "surrogateescape") for needle in state["license_needles"]]
+        # Header is read in a window sized from rendered templates, extended only while header may be cut off by it
+        state["header_window_max"] = self.config.get("header_window_max") or 16384
+        state["header_windows"] = {}
+        self.share_compiled_state(state)
+
+    def share_compiled_state(self, state):
+        self.compiled_state = state
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    """
+    Compiles file type patterns into dispatch table, preserving "first pattern wins" order. Like exclusions, each pattern
+    is matched against path relative to the folder of configuration file which declares it: patterns declared by nested
+    configuration (given as declared) against path relative to its folder, patterns inherited from parent scope the same
+    way as in parent scope. Patterns are grouped by that folder, as (path prefix, patterns, indices of file type defs).
+    """
+    def init_file_types(self, parent=None, declared=None):
+        file_types = self.config["file_types"]
+        self.file_type_names = list(file_types)
+        self.file_type_defs = list(file_types.values())
+        self.file_type_prefixes = {pattern: self.scope_prefix if parent is None or pattern in (declared or {}) else parent.file_type_prefixes[pattern]
+            for pattern in file_types}
+        groups = collections.OrderedDict()
+        for index, pattern in enumerate(file_types):
+            groups.setdefault(self.file_type_prefixes[pattern], []).append((pattern, index))
+        self.file_type_matchers = [(prefix, FnmatchSet([x[0] for x in group]), [x[1] for x in group]) for prefix, group in groups.items()]
+
+    """
+    Reads configuration files and applies arguments on top of them, returning effective configuration
+    """
+    def build_config(self, config_override, kwargs):
+        config = self.read_config(sys.path[0] + os.path.sep + 'license_check.yaml')
         if os.path.exists(config_override):
-            self.config = self.deep_merge(self.config, self.read_config(config_override))
+            config = self.deep_merge(config, self.read_config(config_override))
         else:
             logging.info("Skipping non-existent configuration file %s" % config_override)
-        self.config.update(kwargs)
-        if self.config["add_exclude"]:
-            self.config["exclude"].extend(self.config["add_exclude"])
+        config.update(kwargs)
+        if config["add_exclude"]:
+            config["exclude"].extend(config["add_exclude"])
         if kwargs.get("add_exclude_cli"):
-            self.config["exclude"].extend(kwargs["add_exclude_cli"].split(","))
+            config["exclude"].extend(kwargs["add_exclude_cli"].split(","))
         # start_year and end_year may be come as None from argparse
         current_year = datetime.datetime.now().year
-        self.config["start_year"] = self.config["start_year"] if self.config.get("start_year") else current_year
-        self.config["end_year"] = self.config["end_year"] if self.config.get("end_year") else current_year
-        self.config["ignore_year"] = self.config["ignore_year"] if self.config.get("ignore_year") else False
-        if logging.getLogger().isEnabledFor(logging.DEBUG):
-            logging.debug("Effective configuration:\n" + yaml.safe_dump(self.config))
-        # Build dict {type_name: (main_pattern, [additional_patterns])}
-        self.license_pattern_by_type = {}
-        for type_name in self.config["comment_types"]:
-            type_def = self.config["comment_types"][type_name]
-            self.license_pattern_by_type[type_name] = (
-                self.template_to_pattern(self.config["license_template"], type_def),
-                list(map(lambda x: self.template_to_pattern(x, type_def), self.config["additional_templates"]))
-            )
-        # Cache exclusion computations
-        self.exclusion_cache = {}
+        config["start_year"] = config["start_year"] if config.get("start_year") else current_year
+        config["end_year"] = config["end_year"] if config.get("end_year") else current_year
+        config["ignore_year"] = config["ignore_year"] if config.get("ignore_year") else False
+        # jobs may come as None from argparse, 0 means one worker per CPU
+        config["jobs"] = config["jobs"] if config.get("jobs") is not None else 1
+        if config["jobs"] == 0:
+            config["jobs"] = os.cpu_count() or 1
+        config["io_depth"] = config["io_depth"] if config.get("io_depth") is not None else 0
+        return config
+
+    """
+    Writes configuration to configuration cache, together with pattern sources of file types built so far (see
+    header_sources()), if there are new ones
+    """
+    def save_combined_sources(self):
+        if self.cached_config_key and len(self.combined_sources) > self.cached_sources_count:
+            self.save_cached_config(self.cached_config_key, {"config": self.config, "combined": self.combined_sources, "needles": self.license_needles})
+            self.cached_sources_count = len(self.combined_sources)
+
+    """
+    Returns hash of configuration keys affecting check results, see cache_fingerprint_keys
+    """
+    def results_fingerprint(self, config):
+        return hashlib.sha256(json.dumps({k: config.get(k) for k in self.cache_fingerprint_keys}, sort_keys=True).encode()).hexdigest()
+
+    def compiled_config_key(self, config):
+        return json.dumps({k: config.get(k) for k in self.compiled_config_keys}, sort_keys=True)
+
+    """
+    Returns checker for files in given folder (path relative to current directory, "" for current directory itself),
+    which is the checker of the closest folder with nested configuration file, or this checker if there is none. Scopes
+    are resolved once per folder. has_config tells if folder contains configuration file, if already known from
+    directory listing.
+    """
+    def config_scope(self, directory, has_config=None):
+        scope = self.scopes.get(directory)
+        if scope is None:
+            if not directory or directory == os.path.pardir or directory.startswith(os.path.pardir + os.path.sep) or os.path.isabs(directory):
+                # Configuration of current directory is the top level one, folders outside of it are not looked into
+                scope = self
+            else:
+                parent = self.config_scope(os.path.dirname(directory))
+                config_file = os.path.join(directory, self.nested_config_name)
+                if has_config is None:
+                    has_config = os.path.isfile(config_file)
+                scope = parent.nested_scope(directory, config_file) if has_config else parent
+            self.scopes[directory] = scope
+        return scope
+
+    """
+    Returns checker for folder with nested configuration file, merged over configuration of this checker. Exclusion
+    patterns of nested configuration add to those of parent folders, and, like file type patterns it declares, are
+    matched against paths relative to the folder (see init_file_types()). Compiled patterns are shared by all scopes with
+    the same templates, comment and file types. Scan settings (jobs, cache, git mode, etc) are taken from top level configuration.
+    """
+    def nested_scope(self, directory, config_file):
+        logging.info("Using nested configuration %s" % config_file)
+        nested_config = self.read_config(config_file)
+        scope = copy.copy(self)
+        scope.config = self.deep_merge(self.config, nested_config)
+        scope.config["engine"] = scope.config["engine"] if scope.config.get("engine") else "regex"
+        scope.parent = self
+        scope.scope_prefix = directory + os.path.sep
+        scope.exclude_patterns = FnmatchSet((nested_config.get("exclude") or []) + (nested_config.get("add_exclude") or []))
+        scope.exclusion_cache = collections.OrderedDict()
+        # Only configuration of top level checker is cached
+        scope.cached_config_key = None
+        # Results of nested scopes are kept in the same result cache, apart from results of other configurations
+        scope.cache_key_prefix = self.results_fingerprint(scope.config)[:16] + ":"
+        key = self.compiled_config_key(scope.config)
+        shared = self.compiled_scopes.get(key)
+        if shared is None:
+            scope.init_compiled_state()
+            self.compiled_scopes[key] = scope
+        else:
+            scope.share_compiled_state(shared.compiled_state)
+        scope.init_file_types(self, nested_config.get("file_types"))
+        return scope
+
+    """
+    Returns key of effective configuration in configuration cache: hash of contents of configuration files, arguments,
+    current year (default for start and end year) and of this script itself. Files are hashed without being parsed.
+    """
+    def config_cache_key(self, kwargs):
+        key = hashlib.sha256()
+        script = os.stat(os.path.abspath(__file__))
+        key.update(json.dumps([script.st_size, script.st_mtime_ns, datetime.datetime.now().year, os.cpu_count(), kwargs],
+            sort_keys=True, default=str).encode())
+        for config_file in self.config_files:
+            try:
+                with open(config_file, "rb") as f:
+                    key.update(hashlib.sha256(f.read()).digest())
+            except FileNotFoundError:
+                key.update(b"-")
+        return key.hexdigest()
+
+    """
+    Returns cached effective configuration, pattern sources and license needles for given key, or None. Compiled regex
+    objects can't be stored, so patterns are kept as sources and compiled lazily. YAML parser is not imported at all when
+    configuration is found in cache.
+    """
+    def load_cached_config(self, key):
+        try:
+            with open(self.config_cache_file) as f:
+                data = json.load(f)
+            entry = data["entries"].get(key)
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.warning("Discarding unreadable configuration cache %s: %s" % (self.config_cache_file, e))
+            return None
+        if entry:
+            logging.info("Using cached configuration from %s" % self.config_cache_file)
+        return entry
+
+    def save_cached_config(self, key, entry):
+        try:
+            with open(self.config_cache_file) as f:
+                entries = json.load(f)["entries"]
+            # Keep most recently built configurations only, dicts preserve insertion order
+            entries = {k: v for k, v in list(entries.items())[-(self.config_cache_entries - 1):] if k != key}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            entries = {}
+        entries[key] = entry
+        tmp_file = self.config_cache_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump({"entries": entries}, f, separators=(",", ":"))
+            os.replace(tmp_file, self.config_cache_file)
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning("Can't write configuration cache %s: %s" % (self.config_cache_file, e))
 
     def read_config(self, config_file):
         logging.info("Parsing config file %s ..." % os.path.realpath(config_file))
+        # Importing yaml takes a noticeable part of startup time, so it's deferred until a file needs to be parsed
+        import yaml
         with open(config_file) as f:
-            config = yaml.load(f, Loader=yaml.SafeLoader)
+            # libyaml based loader is several times faster, if PyYAML was built with it
+            config = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
         if "file_types" in config and isinstance(config["file_types"], list):
             logging.warning("Detected v1 list style config for file_types, converting to dict")
             config["file_types"] = dict({f["pattern"] : {k: v for k, v in f.items() if k != "pattern"} for f in config["file_types"]})
@@ -101,20 +1016,196 @@ class LicenseCheck(object):
     (i.e. taking into account shebang line, comment start/end, line prefixes, etc).
     """
     def template_to_pattern(self, template, type_def):
+        return "^(?P<shebang>" + type_def["shebang_pattern"] + ")?(?P<license>" + self.license_body_pattern(template, type_def) + ")?"
+
+    """
+    Converts template to regex pattern of license header itself, following shebang (see template_to_pattern())
+    """
+    def license_body_pattern(self, template, type_def):
         license_pattern = re.escape(template.strip()) \
-            .replace(r'\[year\]', r'\[?(?P<start_year>[0-9\- ,]*)(?P<end_year>[0-9]{4})\]?') \
-            .replace(r'\[owner\]', r'(?P<owner>[a-zA-Z0-9 \-,/]+)') \
+            .replace(r'\[year\]', self.year_pattern) \
+            .replace(r'\[owner\]', self.owner_pattern) \
             .split("\n")
-        line_prefix = re.sub(r'(\\ )+', r'\ *', re.escape(type_def["line_prefix"]))
+        line_prefix = self.line_prefix_pattern(type_def)
         return \
-            "^(?P<shebang>" + type_def["shebang_pattern"] + ")?" + \
-            "(?P<license>\n*" + \
+            "\n*" + \
             (type_def["insert_before_pattern"] if "insert_before_pattern" in type_def else re.escape(type_def["insert_before"])) + \
             "(" + line_prefix + "\n)*" + \
             "\n*".join(map(lambda x:  (("(" + line_prefix + ")?") if x == "\\" else line_prefix) + x + " *", license_pattern)) + "\n*" + \
             "(" + line_prefix + "\n)*" + \
-            (type_def["insert_after_pattern"] if "insert_after_pattern" in type_def else re.escape(type_def["insert_after"])) + \
-            ")?"
+            (type_def["insert_after_pattern"] if "insert_after_pattern" in type_def else re.escape(type_def["insert_after"]))
+
+    """
+    Converts line prefix to regex, allowing any number of spaces in place of spaces.
+    """
+    @staticmethod
+    def line_prefix_pattern(type_def):
+        return re.sub(r'(\\ )+', r'\ *', re.escape(type_def["line_prefix"]))
+
+    """
+    Returns literal text, which any string matching given regex pattern starts with (i.e. "<?xml" for XML declaration).
+    """
+    @staticmethod
+    def literal_prefix(pattern):
+        prefix = re.match(r'\^?((?:\\[^A-Za-z0-9]|[^\\.^$*+?{}\[\]|()])*)(.?)', pattern)
+        literal = re.sub(r'\\(.)', r'\1', prefix.group(1))
+        # Last character is optional, if followed by quantifier
+        return literal[:-1] if prefix.group(2) in ["?", "*", "{"] else literal
+
+    def compile_pattern(self, template, type_def):
+        if self.config["engine"] == "parser":
+            return HeaderParser(template, type_def)
+        return re.compile(self.template_to_pattern(template, type_def))
+
+    """
+    Returns (main_pattern, [additional_patterns]) of comment type, compiling them on first use. These are tried one by
+    one by the parser engine (see match_header_chain()) and in license_check_bench.py; regex engine matches
+    headers with pattern sources of header_sources() instead.
+    """
+    def license_patterns(self, type_name):
+        patterns = self.license_pattern_by_type.get(type_name)
+        if patterns is None:
+            type_def = self.config["comment_types"][type_name]
+            patterns = (self.compile_pattern(self.config["license_template"], type_def),
+                [self.compile_pattern(x, type_def) for x in self.config["additional_templates"]])
+            self.license_pattern_by_type[type_name] = patterns
+        return patterns
+
+    """
+    Returns [main source, combined source, branch roles, branch group names] of patterns check_file() tries for a file
+    type with regex engine, built on first use and kept in configuration cache. Main source is the pattern of main
+    template with main comment type, which matches headers of most files, so it is tried on its own. Combined source
+    joins the patterns tried after it into a single regex, so that files failing the check are matched with one scan,
+    instead of one per pattern: main template with alternative comment type ("alternative") and additional templates
+    ("additional"), in the order patterns are tried one by one, so that the first branch matching with license decides
+    the same way. Last branch ("shebang") always matches, with shebang of the last pattern which would be tried, and is
+    the only one if there are no other patterns. Named groups are numbered by branch, see match_header().
+    In a separate pattern, license is optional and shebang is matched greedily, so license is looked for only after
+    the shebang, if there is one. In a branch, license is required, so regex engine would retry it without the shebang,
+    and could match license where the separate pattern doesn't. Lookahead captures shebang and backreference consumes
+    it, which works as an atomic group (not available before Python 3.11): branch commits to the shebang matched first.
+    """
+    def header_sources(self, file_type_def):
+        key = file_type_def["type"] + "|" + (file_type_def.get("alternative_type") or "")
+        sources = self.combined_sources.get(key)
+        if sources is None:
+            comment_types = self.config["comment_types"]
+            main_source = self.template_to_pattern(self.config["license_template"], comment_types[file_type_def["type"]])
+            branches = []
+            if "alternative_type" in file_type_def:
+                branches.append(("alternative", file_type_def["alternative_type"], self.config["license_template"]))
+            branches += [("additional", file_type_def["type"], template) for template in self.config["additional_templates"]]
+            branch_sources = []
+            names = []
+            for i, (role, type_name, template) in enumerate(branches):
+                body = self.license_body_pattern(template, comment_types[type_name])
+                branch_sources.append("(?=(?P<shebang_%d>%s)?)(?(shebang_%d)(?P=shebang_%d))(?P<license_%d>%s)" % (i, comment_types[type_name]["shebang_pattern"], i, i, i, body))
+                names.append(["shebang", "license"] + re.findall(r'\(\?P<(start_year|end_year|owner)>', body))
+            shebang_type = branches[-1][1] if branches else file_type_def["type"]
+            branch_sources.append("(?P<shebang_%d>%s)?" % (len(branches), comment_types[shebang_type]["shebang_pattern"]))
+            names.append(names[-1] if names else ["shebang", "license"] + re.findall(r'\(\?P<(start_year|end_year|owner)>', main_source))
+            branch_sources = [re.sub(r'\(\?P<(start_year|end_year|owner)>', r'(?P<\1_%d>' % i, source) for i, source in enumerate(branch_sources)]
+            combined_source = "^(?:" + "|".join("(?P<branch_%d>%s)" % (i, source) for i, source in enumerate(branch_sources)) + ")"
+            sources = [main_source, combined_source, [branch[0] for branch in branches] + ["shebang"], names]
+            self.combined_sources[key] = sources
+        return sources
+
+    """
+    Returns compiled main (part 0) or combined (part 1) pattern of file type, see header_sources(). Combined pattern is
+    compiled only once a file of the type doesn't match the main one.
+    """
+    def combined_pattern(self, file_type_def, part):
+        key = (file_type_def["type"], file_type_def.get("alternative_type"), part)
+        pattern = self.combined_pattern_by_type.get(key)
+        if pattern is None:
+            pattern = re.compile(self.header_sources(file_type_def)[part])
+            self.combined_pattern_by_type[key] = pattern
+        return pattern
+
+    """
+    Matches header content against main pattern of file type, then, if it doesn't match with license, against combined
+    pattern of the remaining ones with a single scan. Returns (role, matcher), where role tells which pattern matched
+    with license ("main", "alternative", "additional"), or is None, if none did. Matcher has the same groups as match of
+    the separate pattern.
+    """
+    def match_header(self, file_type_def, content):
+        result = self.search_pattern(self.combined_pattern(file_type_def, 0), content, "main")
+        if result.group("license"):
+            return "main", result
+        _, _, roles, names = self.header_sources(file_type_def)
+        if len(roles) == 1:
+            # No other patterns, shebang is taken from the main one
+            return None, result
+        result = self.search_pattern(self.combined_pattern(file_type_def, 1), content, "combined")
+        branch = int(result.lastgroup[len("branch_"):])
+        if roles[branch] == "shebang":
+            # Groups of the last pattern, which matched without license
+            groups = dict.fromkeys(names[branch])
+            groups["shebang"] = result.group("shebang_%d" % branch)
+            return None, HeaderMatch(groups)
+        matcher = HeaderMatch({name: result.group("%s_%d" % (name, branch)) for name in names[branch]})
+        if self.stats:
+            self.stats.count("%s template matches" % roles[branch])
+        return roles[branch], matcher
+
+    """
+    Tries patterns of file type one by one (used by parser engine), returns the same as match_header()
+    """
+    def match_header_chain(self, file_type_def, content):
+        file_type = file_type_def["type"]
+        logging.debug("Trying main file comment type for %s" % file_type)
+        pattern = self.license_patterns(file_type)[0]
+        result = self.search_pattern(pattern, content, "main")
+        if result and result.groupdict().get("license"):
+            return "main", result
+        if "alternative_type" in file_type_def:
+            logging.debug("Trying alternate file comment type %s" % file_type_def["alternative_type"])
+            pattern = self.license_patterns(file_type_def["alternative_type"])[0]
+            result = self.search_pattern(pattern, content, "alternative")
+            if result and result.groupdict().get("license"):
+                return "alternative", result
+        logging.debug("Main pattern did not match, trying additional patterns")
+        for pattern in self.license_patterns(file_type)[1]:
+            result = self.search_pattern(pattern, content, "additional")
+            if result and result.groupdict().get("license"):
+                return "additional", result
+            logging.debug("Additional pattern did not match")
+        return None, result
+
+    """
+    Returns (shebang pattern, literal prefix of shebang pattern) of comment type, compiling it on first use
+    """
+    def shebang_pattern(self, type_name):
+        pattern = self.shebang_pattern_by_type.get(type_name)
+        if pattern is None:
+            shebang_pattern = self.config["comment_types"][type_name]["shebang_pattern"]
+            pattern = (re.compile("^(?P<shebang>" + shebang_pattern + ")?"), self.literal_prefix(shebang_pattern))
+            self.shebang_pattern_by_type[type_name] = pattern
+        return pattern
+
+    """
+    Finds literal text, which must be present in the file if any of license templates matches it. This is either text
+    common to all templates (i.e. "Copyright"), or, if there is no such text, the longest literal fragment of each template.
+    Returns empty list if some template has no literal text at all, meaning there's nothing to look for.
+    """
+    def find_license_needles(self, templates):
+        fragments = []
+        for template in templates:
+            template_fragments = [f.strip() for line in template.strip().split("\n") for f in re.split(r'\[(?:year|owner)\]', line)]
+            template_fragments = [f for f in template_fragments if f]
+            if not template_fragments:
+                return []
+            fragments.append(template_fragments)
+        common = ""
+        for fragment in min(fragments, key=lambda x: sum(map(len, x))):
+            for length in range(len(fragment), max(len(common), self.min_needle_length - 1), -1):
+                common = next((fragment[i:i + length] for i in range(len(fragment) - length + 1)
+                    if all(any(fragment[i:i + length] in f for f in template_fragments) for template_fragments in fragments)), common)
+                if len(common) == length:
+                    break
+        if common:
+            return [common]
+        return [max(template_fragments, key=len) for template_fragments in fragments]
 
     """
     Checks if given path matches exclusion configuration. Matching performed for nested paths, starting from original path
@@ -122,7 +1213,10 @@ class LicenseCheck(object):
     but belonging to excluded folder.
     """
     def matches_exclude(self, path):
-        relpath = os.path.relpath(path)
+        return self.matches_exclude_relpath(os.path.relpath(path))
+
+    def matches_exclude_relpath(self, relpath):
+        path = relpath
         logging.debug("Checking \"%s\" for exclusion" % (relpath))
         while relpath:
             if self.matches_exclude_path(relpath):
@@ -134,50 +1228,431 @@ class LicenseCheck(object):
         return False
 
     def matches_exclude_path(self, path):
-        if path in self.exclusion_cache:
-            logging.debug("Found exclusion check result for \"%s\" in cache as %s" % (path, str(self.exclusion_cache[path])))
-            return self.exclusion_cache[path]
-        for p in self.config["exclude"]:
-            if fnmatch.fnmatch(path, p):
-                logging.debug("Matching \"%s\" against \"%s\" .... matched!" % (path, p))
-                self.exclusion_cache[path] = True
-                return True
+        if self.stats:
+            started = time.perf_counter()
+        excluded = self.exclusion_cache.get(path)
+        cached = excluded is not None
+        if cached:
+            self.exclusion_cache.move_to_end(path)
+        else:
+            if self.parent is not None:
+                excluded = self.parent.matches_exclude_path(path)
             else:
-                logging.debug("Matching \"%s\" against \"%s\" .... no match!" % (path, p))
-        self.exclusion_cache[path] = False
-        return False
+                excluded = path in self.cache_relpaths
+            if not excluded and path.startswith(self.scope_prefix):
+                index = self.exclude_patterns.first_match(path[len(self.scope_prefix):])
+                if index is not None:
+                    logging.debug("Path \"%s\" matches exclusion pattern \"%s\"" % (path, self.exclude_patterns.patterns[index]))
+                excluded = index is not None
+            self.exclusion_cache[path] = excluded
+            if len(self.exclusion_cache) > self.exclusion_cache_size:
+                self.exclusion_cache.popitem(last=False)
+        if self.stats:
+            self.stats.add("exclude", time.perf_counter() - started)
+            self.stats.count("exclusion cache hits" if cached else "exclusion cache misses")
+        return excluded
 
     """
-    Main working method
+    Yields names of files to be checked, walking directories and applying exclusions. Explicitly provided targets are
+    checked against exclusions together with all their parent folders. While walking, excluded directories are not
+    descended into, so only the path of each directory entry itself needs to be checked.
     """
-    def check(self, scan_targets, fix=False):
-        result = []
+    def iter_targets(self, scan_targets):
+        for filename, relpath in self.iter_target_paths(scan_targets):
+            yield filename
+
+    """
+    Same as iter_targets(), but yields tuples (filename, relpath), where relpath is the path relative to current folder,
+    used for matching exclusions and file types. It is built while walking, so it is not recomputed for each file.
+    """
+    def iter_target_paths(self, scan_targets, fix=False):
         if isinstance(scan_targets, str):
             scan_targets = [scan_targets]
+        if self.config.get("git") or self.config.get("changed_since") or self.config.get("staged"):
+            for path in self.iter_git_targets(scan_targets, fix):
+                yield path, path
+            return
         for scan_target in scan_targets:
-            if self.matches_exclude(scan_target):
+            relpath = os.path.relpath(scan_target)
+            try:
+                mode = os.stat(scan_target).st_mode
+            except OSError:
+                mode = 0
+            if self.config_scope(os.path.dirname(relpath)).matches_exclude_relpath(relpath):
                 logging.info("Excluding file or directory %s as it matches excludes pattern" % scan_target)
-            elif os.path.isdir(scan_target):
+            elif stat.S_ISDIR(mode):
                 logging.info("Scanning directory %s" % scan_target)
-                for dirname, subdirs, filenames in os.walk(scan_target):
-                    for subdir in subdirs.copy():
-                        if self.matches_exclude(dirname + os.path.sep + subdir):
-                            logging.info("Excluding directory %s/%s as it matches excludes pattern" % (dirname, subdir))
-                            subdirs.remove(subdir)
-                    for filename in filenames:
-                        filename = dirname + os.path.sep + filename
-                        if os.path.islink(filename):
-                            logging.info("Excluding file %s as it is a link" % filename)
-                        elif self.matches_exclude(filename):
-                            logging.info("Excluding file %s as it matches excludes pattern" % filename)
-                        else:
-                            result.append(self.check_file(filename, fix))
-            elif os.path.isfile(scan_target):
+                yield from self.walk_directory(scan_target, relpath)
+            elif stat.S_ISREG(mode):
                 logging.info("Scanning file %s" % scan_target)
-                result.append(self.check_file(scan_target, fix))
+                yield scan_target, relpath
             else:
                 logging.warning("Can't scan %s - not regular file or directory" % scan_target)
-        return result
+
+    """
+    Walks directory with os.scandir(), in the same order as os.walk(). Entry types are taken from directory listing, so
+    normally no stat() calls are needed, and paths relative to current folder are built by concatenation.
+    """
+    def walk_directory(self, top, reltop):
+        relprefix = "" if reltop == os.path.curdir else reltop + os.path.sep
+        chain = None
+        absprefix = None
+        if self.config.get("respect_gitignore"):
+            absprefix = os.path.join(os.path.abspath(top), "")
+            chain = self.parent_gitignores(absprefix)
+        # Stack of folders to be walked: (path, relative path prefix, absolute path prefix, applicable .gitignore files)
+        stack = [(os.path.join(top, ""), relprefix, absprefix, chain)]
+        while stack:
+            dirprefix, relprefix, absprefix, chain = stack.pop()
+            try:
+                with os.scandir(dirprefix) as it:
+                    entries = list(it)
+            except OSError as e:
+                logging.warning("Can't scan directory %s: %s" % (dirprefix, e))
+                continue
+            if self.walked_directories is not None:
+                self.walked_directories.append((dirprefix, relprefix))
+            scope = self.config_scope(relprefix[:-1], any(entry.name == self.nested_config_name for entry in entries))
+            if chain is not None and any(entry.name == ".gitignore" for entry in entries) and self.load_gitignore(absprefix):
+                # .gitignore files of each folder apply to its subfolders only, so the chain is copied
+                chain = chain + [(absprefix, self.load_gitignore(absprefix))]
+            subdirs = []
+            for entry in entries:
+                name = entry.name
+                relpath = relprefix + name
+                if entry.is_symlink():
+                    logging.info("Excluding %s%s as it is a link" % (dirprefix, name))
+                elif entry.is_dir():
+                    if scope.matches_exclude_path(relpath):
+                        logging.info("Excluding directory %s%s as it matches excludes pattern" % (dirprefix, name))
+                    elif chain and self.matches_gitignore(chain, absprefix + name, True):
+                        logging.info("Excluding directory %s%s as it is ignored by git" % (dirprefix, name))
+                    else:
+                        subdirs.append((dirprefix + name + os.path.sep, relpath + os.path.sep,
+                            absprefix + name + os.path.sep if chain is not None else None, chain))
+                elif not entry.is_file():
+                    logging.info("Excluding %s%s as it is not a regular file" % (dirprefix, name))
+                elif scope.matches_exclude_path(relpath):
+                    logging.info("Excluding file %s%s as it matches excludes pattern" % (dirprefix, name))
+                elif chain and self.matches_gitignore(chain, absprefix + name, False):
+                    logging.info("Excluding file %s%s as it is ignored by git" % (dirprefix, name))
+                else:
+                    yield dirprefix + name, relpath
+            stack.extend(reversed(subdirs))
+
+    """
+    Returns parsed .gitignore file in given folder (ending with path separator), or None if there is none. Each file is
+    parsed once per run.
+    """
+    def load_gitignore(self, absprefix):
+        if absprefix not in self.gitignore_cache:
+            gitignore = None
+            try:
+                with open(absprefix + ".gitignore", errors="surrogateescape") as f:
+                    gitignore = GitIgnore(f.readlines())
+            except OSError as e:
+                logging.debug("Can't read %s.gitignore: %s" % (absprefix, e))
+            self.gitignore_cache[absprefix] = gitignore
+        return self.gitignore_cache[absprefix]
+
+    """
+    Returns .gitignore files from parent folders of scan target up to the top of git working tree, top to bottom. Nothing
+    is returned if scan target is not within git working tree.
+    """
+    def parent_gitignores(self, absprefix):
+        chain = []
+        folder = absprefix.rstrip(os.path.sep)
+        while not os.path.exists(os.path.join(folder, ".git")):
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                return []
+            folder = parent
+            gitignore = self.load_gitignore(folder.rstrip(os.path.sep) + os.path.sep)
+            if gitignore:
+                chain.insert(0, (folder.rstrip(os.path.sep) + os.path.sep, gitignore))
+        return chain
+
+    """
+    Checks path against .gitignore files applicable to it, the deepest .gitignore file with matching pattern decides.
+    """
+    @staticmethod
+    def matches_gitignore(chain, abspath, is_dir):
+        for absprefix, gitignore in reversed(chain):
+            ignored = gitignore.match(abspath[len(absprefix):], is_dir)
+            if ignored is not None:
+                return ignored
+        return False
+
+    """
+    Yields names of files within scan targets, which are tracked by git, or, if changed_since is configured, were added or
+    modified since merge base of that ref and HEAD (including uncommitted changes). Files are listed from git index,
+    so untracked and ignored files are never visited. Same exclusion rules as for directory walk apply, links and
+    submodules are skipped.
+    If staged is configured, yields files added or modified in git index, to be read from index rather than from working
+    tree. With fix, files without unstaged changes are read from working tree instead (same content), so they can be
+    fixed and staged again, while files with unstaged changes are only checked.
+    """
+    def iter_git_targets(self, scan_targets, fix=False):
+        changed_since = self.config.get("changed_since")
+        deleted = set()
+        unstaged = set()
+        # Checkers of nested scopes share the same dict
+        self.staged_blobs.clear()
+        self.restage_paths = []
+        if self.config.get("staged"):
+            logging.info("Scanning files staged in git index in %s" % " ".join(scan_targets))
+            if fix:
+                unstaged.update(self.run_git(["diff", "-z", "--name-only", "--relative", "--"] + scan_targets).split("\0"))
+            fields = self.run_git(["diff", "-z", "--cached", "--raw", "--no-abbrev", "--no-renames", "--diff-filter=ACMT", "--relative", "--"] + scan_targets).split("\0")
+            entries = [(meta.split(" ")[1], path, meta.split(" ")[3]) for meta, path in zip(fields[0::2], fields[1::2])]
+        elif changed_since:
+            base = self.run_git(["merge-base", changed_since, "HEAD"]).strip()
+            logging.info("Scanning files changed since %s (%s)" % (changed_since, base))
+            # Raw format with -z is ":<old mode> <new mode> <old sha> <new sha> <status>\0<path>\0" per file
+            fields = self.run_git(["diff", "-z", "--raw", "--no-renames", "--diff-filter=ACMT", "--relative", base, "--"] + scan_targets).split("\0")
+            entries = [(meta.split(" ")[1], path, None) for meta, path in zip(fields[0::2], fields[1::2])]
+        else:
+            logging.info("Scanning files tracked by git in %s" % " ".join(scan_targets))
+            deleted.update(self.run_git(["ls-files", "-z", "--deleted", "--"] + scan_targets).split("\0"))
+            # Stage format is "<mode> <sha> <stage>\t<path>", unmerged files are listed once per stage
+            entries = []
+            for entry in self.run_git(["ls-files", "-z", "--stage", "--"] + scan_targets).split("\0"):
+                if entry:
+                    meta, path = entry.split("\t", 1)
+                    if not entries or entries[-1][1] != path:
+                        entries.append((meta.split(" ")[0], path, None))
+        paths = []
+        for mode, path, blob in entries:
+            if mode == "120000":
+                logging.info("Excluding file %s as it is a link" % path)
+            elif mode == "160000":
+                logging.info("Excluding submodule %s" % path)
+            elif path in deleted:
+                logging.info("Excluding file %s as it is deleted in working tree" % path)
+            elif self.config_scope(os.path.dirname(path)).matches_exclude_relpath(path):
+                logging.info("Excluding file %s as it matches excludes pattern" % path)
+            else:
+                if blob and fix and path not in unstaged:
+                    self.restage_paths.append(path)
+                elif blob:
+                    self.staged_blobs[path] = blob
+                paths.append(path)
+        if self.staged_blobs and self.config["jobs"] <= 1:
+            # Files are read in the same order as listed. Worker processes of a parallel scan read blobs on demand.
+            self.blob_reader.prefetch([self.staged_blobs[path] for path in paths if path in self.staged_blobs])
+        yield from paths
+
+    @staticmethod
+    def run_git(args, input=None):
+        import subprocess
+        try:
+            return subprocess.run(["git"] + args, check=True, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                encoding="utf-8", errors="surrogateescape").stdout
+        except subprocess.CalledProcessError as e:
+            raise ValueError("Command git %s failed: %s" % (args[0], e.stderr.strip()))
+        except OSError as e:
+            raise ValueError("Can't run git: %s" % e)
+
+    """
+    Resets state which must not outlive a single scan, when the same instance is reused for another one (see --serve).
+    Compiled patterns and exclusion cache only depend on configuration and are kept.
+    """
+    def start_run(self):
+        self.gitignore_cache = {}
+        # Nested configuration files are read again, checkers of nested scopes share state of the previous run
+        self.scopes = {}
+        self.compiled_scopes = {self.compiled_config_key(self.config): self}
+        if self.stats:
+            self.stats = ScanStats(self.stats.top)
+        self.summary = ResultSummary()
+        if self.result_cache:
+            self.result_cache.start_run()
+
+    """
+    Main working method, returns list of results
+    """
+    def check(self, scan_targets, fix=False):
+        return list(self.iter_check(scan_targets, fix))
+
+    """
+    Yields check results as soon as files are checked. With jobs > 1, files are checked by a pool of worker processes
+    while directories are still being walked. Checker state is handed over to each worker once, at pool start. Results
+    are yielded in walk order. If max_failures is given, walking and checking stops once that many files failed the check.
+    """
+    def iter_check(self, scan_targets, fix=False, max_failures=None):
+        import multiprocessing
+        targets = self.iter_target_paths(scan_targets, fix)
+        if self.config.get("shard"):
+            targets = ((filename, relpath) for filename, relpath in targets if self.in_shard(relpath))
+        if self.stats:
+            targets = self.stats.timed_iter(targets, "walk")
+        if self.config["io_depth"] > 0 and not self.config.get("staged"):
+            # Blobs of staged files are streamed ahead by git already
+            targets = self.iter_read_ahead(targets)
+        else:
+            targets = ((filename, relpath, None) for filename, relpath in targets)
+        try:
+            if self.config["jobs"] <= 1:
+                checked = (self.check_target(filename, fix, relpath, prefetched) + (None,) for filename, relpath, prefetched in targets)
+                yield from self.collect_results(checked, max_failures)
+            else:
+                if self.config.get("staged"):
+                    # Staged blobs are known once targets are listed, and are handed over to workers with checker state
+                    targets = list(targets)
+                with multiprocessing.Pool(self.config["jobs"], initializer=init_worker, initargs=(self,)) as pool:
+                    checked = pool.imap(check_file_worker, ((filename, relpath, fix, prefetched) for filename, relpath, prefetched in targets),
+                        chunksize=self.worker_chunksize)
+                    yield from self.collect_results(checked, max_failures)
+        finally:
+            self.blob_reader.close()
+            if self.restage_paths:
+                # Files which were not changed by fix are left as they are by git add
+                logging.info("Staging %d checked file(s) again" % len(self.restage_paths))
+                self.run_git(["add", "--pathspec-from-file=-", "--pathspec-file-nul"], "\0".join(self.restage_paths))
+                self.restage_paths = []
+
+    """
+    Tells if file belongs to the shard of this run (see --shard). Files are assigned to shards by hash of their path
+    relative to current directory, so that each file is checked by exactly one of the shards, whichever node runs it.
+    """
+    def in_shard(self, relpath):
+        index, count = self.config["shard"]
+        digest = hashlib.blake2b(relpath.encode("utf-8", "surrogateescape"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % count == index - 1
+
+    """
+    Reads headers of targets ahead in a pool of io_depth threads, so that on file systems with high latency of open() and
+    read() (NFS, Lustre) reads of the following files are in flight while a file is checked. Yields (filename, relpath,
+    prefetched) in the same order as targets, where prefetched is passed to check_target(). At most io_depth files are
+    read ahead, which bounds memory used by headers.
+    """
+    def iter_read_ahead(self, targets):
+        import concurrent.futures
+        depth = self.config["io_depth"]
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(depth) as pool:
+            try:
+                for filename, relpath in targets:
+                    scope = self.config_scope(os.path.dirname(relpath))
+                    file_type_def = scope.get_file_type_def(filename, relpath)
+                    future = pool.submit(scope.read_ahead, filename, relpath, file_type_def) if file_type_def else None
+                    pending.append((filename, relpath, future))
+                    if len(pending) > depth:
+                        filename, relpath, future = pending.popleft()
+                        yield filename, relpath, future.result() if future else None
+                while pending:
+                    filename, relpath, future = pending.popleft()
+                    yield filename, relpath, future.result() if future else None
+            finally:
+                # Scan may be stopped early, reads which haven't started yet are not needed
+                for _, _, future in pending:
+                    if future:
+                        future.cancel()
+
+    """
+    Reads file ahead of check in a thread of iter_read_ahead(). Returns (file type definition, stat result or None,
+    header or None, statistics delta or None). Header is not read if result cache has an entry with the same size and
+    mtime. Statistics are collected separately, to be merged by the checking thread.
+    """
+    def read_ahead(self, filename, relpath, file_type_def):
+        stats = ScanStats(self.stats.top) if self.stats else None
+        file_stat = None
+        if self.result_cache:
+            file_stat = os.stat(filename)
+            entry = self.result_cache.get(self.cache_key_prefix + relpath)
+            if entry and entry[0] == file_stat.st_size and entry[1] == file_stat.st_mtime_ns:
+                return file_type_def, file_stat, None, None
+        header = self.read_header(filename, file_type_def, stats)
+        return file_type_def, file_stat, header, stats.drain() if stats else None
+
+    def collect_results(self, checked, max_failures):
+        failures = 0
+        try:
+            for file_result, cache_update, stats_delta in checked:
+                if cache_update:
+                    self.result_cache.put(*cache_update)
+                if stats_delta:
+                    self.stats.merge(stats_delta)
+                if file_result is not None:
+                    file_result.log()
+                    self.summary.add(file_result)
+                yield file_result
+                if file_result is not None and file_result.code > 0:
+                    failures += 1
+                    if max_failures and failures >= max_failures:
+                        logging.warning("Stopping after %d file(s) failed license check" % failures)
+                        return
+        finally:
+            if self.result_cache:
+                self.result_cache.save()
+            self.save_combined_sources()
+
+    """
+    Checks single file found by iter_targets(), recording per-file statistics if enabled
+    """
+    def check_target(self, filename, fix, relpath, prefetched=None):
+        scope = self.config_scope(os.path.dirname(relpath))
+        if scope is not self:
+            return scope.check_target(filename, fix, relpath, prefetched)
+        if fix and filename in self.staged_blobs:
+            logging.warning("Not fixing %s, as it has unstaged changes" % filename)
+            fix = False
+        if prefetched and prefetched[3]:
+            self.stats.merge(prefetched[3])
+        if not self.stats:
+            file_type_def = prefetched[0] if prefetched else self.get_file_type_def(filename, relpath)
+            return self.check_file_cached(filename, fix, file_type_def, relpath, prefetched)
+        started = time.perf_counter()
+        file_type_def = prefetched[0] if prefetched else self.get_file_type_def(filename, relpath)
+        checked = self.check_file_cached(filename, fix, file_type_def, relpath, prefetched)
+        self.stats.add_file(filename, file_type_def["type"] if file_type_def else None, time.perf_counter() - started)
+        return checked
+
+    """
+    Checks file, using persistent result cache if enabled. Returns tuple (result, cache_update), where cache_update is
+    (key, entry) to be stored in cache by the caller (which may be in a different process), or None.
+    Cached result is reused without reading the file if size and mtime didn't change, or if file was modified but
+    license header window is still the same. File stat and header may be given as read ahead by iter_read_ahead().
+    """
+    def check_file_cached(self, filename, fix=False, file_type_def=None, relpath=None, prefetched=None):
+        if relpath is None:
+            relpath = os.path.relpath(filename)
+            file_type_def = self.get_file_type_def(filename, relpath)
+        _, file_stat, header, _ = prefetched or (None, None, None, None)
+        if not self.result_cache or not file_type_def or filename in self.staged_blobs:
+            return self.check_file(filename, fix, header=header, file_type_def=file_type_def, relpath=relpath), None
+        key = self.cache_key_prefix + relpath
+        file_stat = file_stat or os.stat(filename)
+        entry = self.result_cache.get(key)
+        if entry and entry[0] == file_stat.st_size and entry[1] == file_stat.st_mtime_ns:
+            logging.debug("Found check result for %s in cache" % filename)
+            if self.stats:
+                self.stats.count("result cache hits")
+            return self.cached_result(entry, filename, fix, file_type_def), (key, entry)
+        if header is None:
+            header = self.read_header(filename, file_type_def)
+        header_hash = hashlib.blake2b(header, digest_size=16).hexdigest()
+        if entry and entry[2] == header_hash:
+            logging.debug("File %s was modified, but header is the same as in cache" % filename)
+            if self.stats:
+                self.stats.count("result cache hits")
+            return self.cached_result(entry, filename, fix, file_type_def), (key, self.result_cache.new_entry(file_stat, header_hash, entry[3]))
+        result, checked_header = self.check_header(filename, fix, header=header, file_type_def=file_type_def)
+        if fix:
+            return result, None
+        if checked_header is not header:
+            header_hash = hashlib.blake2b(checked_header, digest_size=16).hexdigest()
+        return result, (key, self.result_cache.new_entry(file_stat, header_hash, result.status))
+
+    def cached_result(self, entry, filename, fix, file_type_def):
+        status = CheckStatus(entry[3])
+        if fix and status.code == 0:
+            logging.info(status.message % filename)
+            return None
+        if fix:
+            return self.check_file(filename, fix, file_type_def=file_type_def)
+        # Year and owner are not cached, these are only needed for fix
+        return self.LicenseCheckResult(status, filename, file_type_def["type"])
 
     """
     Evaluate license template (replace [year] and [owner] placeholders, add comment start/end and line prefixes)
@@ -212,22 +1687,31 @@ class LicenseCheck(object):
             else:
                 # Add single year as part of new license header
                 year_replace = str(end_year)
-        type_def = self.config["comment_types"][file_type]
-        license_text = self.config["license_template"].strip()
+        return self.render_template(self.config["license_template"], self.config["comment_types"][file_type], year_replace)
+
+    """
+    Renders template as header text of given comment type, with [owner] and [year] placeholders replaced.
+    """
+    def render_template(self, template, type_def, year):
+        license_text = template.strip()
         if type_def["line_prefix"]:
             license_text = "\n" + license_text + "\n"
             license_text = "\n".join(map(lambda x: (type_def["line_prefix"] + x).rstrip(), license_text.split("\n")))
         return type_def["insert_before"] + \
-            license_text.replace("[owner]", self.config["owner"]).replace("[year]", year_replace) + "\n" + \
+            license_text.replace("[owner]", self.config["owner"]).replace("[year]", year) + "\n" + \
             type_def["insert_after"]
 
-    def fix_or_report(self, code, message, file_type, matcher, fix, filename, outfile):
+    def fix_or_report(self, status, file_type, matcher, fix, filename, outfile, header):
+        code = status.code
+        message = status.message % filename
         if not fix:
-            return self.LicenseCheckResult(code, message, matcher)
+            return self.LicenseCheckResult(status, filename, file_type, matcher)
         if code == 0:
             logging.info(message)
         else:
-            if outfile is None:
+            if self.config.get("diff"):
+                logging.warning("Planning fix of file %s ..." % filename)
+            elif outfile is None:
                 logging.warning("Fixing file %s in place ..." % filename)
             else:
                 logging.warning("Fixing file %s, writing result to %s ..." % (filename, outfile))
@@ -241,88 +1725,1123 @@ class LicenseCheck(object):
                 pos += len(matcher.group("license"))
             else:
                 new_content += self.license_template(file_type)
-            with open(filename) as f:
-                content = f.read()
-            with open(outfile if outfile is not None else filename, "w") as f:
-                f.write(new_content + content[pos:])
+            if self.config.get("diff"):
+                # Nothing is written in diff mode, planned rewrite is returned to be reviewed and applied later
+                return self.LicenseCheckResult(status, filename, file_type, patch=self.diff_header(filename, new_content, header, pos))
+            if self.stats:
+                started = time.perf_counter()
+            self.write_fixed_file(filename, outfile, new_content, header, pos)
+            if self.stats:
+                self.stats.add("fix", time.perf_counter() - started)
+                self.stats.count("files fixed")
         return None
 
-    def check_file(self, filename, fix=False, outfile=None):
-        file_type_def = None
-        for file_pattern in self.config["file_types"]:
-            if fnmatch.fnmatch(os.path.relpath(filename), file_pattern):
-                file_type_def = self.config["file_types"][file_pattern]
-                logging.debug("Matching %s against %s to determine file type .... matched!" % (os.path.relpath(filename), file_pattern))
+    """
+    Returns unified diff, which replaces text before position pos of decoded header with new_content. Diffed text is
+    extended to the end of line, so that hunks consist of whole lines.
+    """
+    def diff_header(self, filename, new_content, header, pos):
+        import difflib
+        content = self.decode_header(header)
+        end = content.find("\n", pos)
+        end = len(content) if end < 0 else end + 1
+        path = os.path.relpath(filename)
+        diff = difflib.unified_diff(content[:end].splitlines(True), (new_content + content[pos:end]).splitlines(True),
+            "a/" + path, "b/" + path)
+        # Last line of a file may have no line end, which must be marked for patch tools
+        return "".join(line if line.endswith("\n") else line + "\n\\ No newline at end of file\n" for line in diff)
+
+    """
+    Parses unified diff written in diff mode. Returns list of (path, hunks), where each hunk is (first line number,
+    [old lines], [new lines]).
+    """
+    @staticmethod
+    def parse_patch(lines):
+        patches = []
+        hunk = None
+        last_line = None
+        old_left = new_left = 0
+        for line in lines:
+            if hunk and line.startswith("\\"):
+                # "\ No newline at end of file" refers to the previous line
+                for lines_of_side in hunk[1:]:
+                    if lines_of_side and last_line is lines_of_side[-1] and last_line.endswith("\n"):
+                        lines_of_side[-1] = last_line[:-1]
+            elif (old_left or new_left) and line[:1] in [" ", "-", "+"]:
+                # Lines of hunk are counted, as removed lines may look like file headers
+                last_line = line[1:]
+                if line[0] != "+":
+                    hunk[1].append(last_line)
+                    old_left -= 1
+                if line[0] != "-":
+                    hunk[2].append(last_line)
+                    new_left -= 1
+            elif line.startswith("+++ "):
+                path = line[4:].rstrip("\n").split("\t")[0]
+                patches.append((path[2:] if path.startswith("b/") else path, []))
+                hunk = None
+            elif line.startswith("@@ "):
+                match = re.match(r'@@ -(\d+)(?:,(\d+))? \+\d+(?:,(\d+))? @@', line)
+                if not match or not patches:
+                    raise ValueError("Malformed patch hunk: %s" % line.rstrip())
+                old_left = int(match.group(2) or 1)
+                new_left = int(match.group(3) or 1)
+                # Hunk of empty old text starts after given line
+                start = int(match.group(1)) + (1 if old_left == 0 else 0)
+                hunk = (start, [], [])
+                patches[-1][1].append(hunk)
+        return patches
+
+    """
+    Applies planned header rewrites of a single file. Only lines covered by hunks are read and compared with the patch,
+    the rest of the file is copied as is.
+    """
+    def apply_file_patch(self, path, hunks):
+        length = max(start - 1 + len(old) for start, old, new in hunks)
+        with open(path, "rb") as f:
+            header = b"".join(f.readline() for _ in range(length))
+        lines = self.decode_header(header).splitlines(True)
+        new_lines = []
+        index = 0
+        for start, old, new in hunks:
+            if lines[start - 1:start - 1 + len(old)] != old:
+                raise ValueError("Patch does not apply to %s, file was changed" % path)
+            new_lines += lines[index:start - 1] + new
+            index = start - 1 + len(old)
+        # Trailing context is left as is, to keep its original line endings
+        context = 0
+        while context < min(len(old), len(new)) and old[-1 - context] == new[-1 - context]:
+            context += 1
+        del new_lines[len(new_lines) - context:]
+        self.write_fixed_file(path, None, "".join(new_lines), header, len("".join(lines[:index - context])))
+        logging.info("Applied patch to %s" % path)
+
+    """
+    Applies patch written in diff mode, writing files in parallel threads. Files are checked to still have the header
+    which was planned to be replaced. Returns number of files, which patch could not be applied to.
+    """
+    def apply_patch(self, lines):
+        import concurrent.futures
+        patches = self.parse_patch(lines)
+        with concurrent.futures.ThreadPoolExecutor(self.apply_threads) as pool:
+            # Files are handed to threads in batches, as per-file synchronization would cost more than small writes
+            batches = [patches[i:i + self.apply_batch_size] for i in range(0, len(patches), self.apply_batch_size)]
+            return sum(pool.map(self.apply_patch_batch, batches))
+
+    def apply_patch_batch(self, patches):
+        failures = 0
+        for path, hunks in patches:
+            try:
+                self.apply_file_patch(path, hunks)
+            except (OSError, ValueError) as e:
+                logging.error("Can't apply patch: %s" % e)
+                failures += 1
+        return failures
+
+    """
+    Writes new header, followed by the rest of original file after position pos of decoded header, to a temporary file
+    next to the target, which then replaces the target. Header bytes already read are reused, the rest of the file is
+    copied by the kernel where possible, so memory use doesn't depend on file size, and the target is never left
+    partially written. File mode and ownership are preserved.
+    """
+    def write_fixed_file(self, filename, outfile, new_content, header, pos):
+        import tempfile
+        target = os.path.realpath(outfile if outfile is not None else filename)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(target), prefix="." + os.path.basename(target) + ".", suffix=".tmp")
+        try:
+            with open(filename, "rb", buffering=0) as src, os.fdopen(fd, "wb") as dst:
+                if self.bom and header.startswith(self.bom):
+                    dst.write(self.bom)
+                dst.write(new_content.encode(self.encoding, "surrogateescape"))
+                dst.write(header[self.header_offset(header, pos):])
+                dst.flush()
+                self.copy_file_tail(src.fileno(), dst.fileno(), len(header))
+                src_stat = os.fstat(src.fileno())
+                os.fchmod(dst.fileno(), stat.S_IMODE(src_stat.st_mode))
+                if outfile is None and hasattr(os, "fchown"):
+                    try:
+                        os.fchown(dst.fileno(), src_stat.st_uid, src_stat.st_gid)
+                    except PermissionError:
+                        logging.debug("Can't preserve ownership of %s" % filename)
+            os.replace(tmp_file, target)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+
+    """
+    Copies file src from given offset to the current position of file dst, using copy_file_range() or sendfile() if
+    supported by platform and file system, otherwise falling back to read() / write() in chunks.
+    """
+    def copy_file_tail(self, src, dst, offset):
+        for copy_call in [getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)]:
+            if copy_call is None:
+                continue
+            try:
+                while True:
+                    if copy_call is os.sendfile:
+                        copied = os.sendfile(dst, src, offset, self.copy_chunk_size)
+                    else:
+                        copied = os.copy_file_range(src, dst, self.copy_chunk_size, offset)
+                    if not copied:
+                        return
+                    offset += copied
+            except OSError as e:
+                if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF]:
+                    raise
+                logging.debug("%s is not supported here (%s), falling back" % (copy_call.__name__, e))
+        os.lseek(src, offset, os.SEEK_SET)
+        while True:
+            chunk = os.read(src, io.DEFAULT_BUFFER_SIZE * 8)
+            if not chunk:
+                return
+            while chunk:
+                chunk = chunk[os.write(dst, chunk):]
+
+    """
+    Returns offset in header bytes, corresponding to position pos in decoded header (see decode_header()).
+    """
+    def header_offset(self, header, pos):
+        text = header.decode(self.encoding, "surrogateescape")
+        if self.bom and header.startswith(self.bom):
+            pos += 1
+        if "\r" in text:
+            # "\r\n" was decoded as a single "\n"
+            index = 0
+            for _ in range(pos):
+                index += 2 if text.startswith("\r\n", index) else 1
+            pos = index
+        return len(text[:pos].encode(self.encoding, "surrogateescape"))
+
+    def get_file_type_def(self, filename, relpath=None):
+        if self.stats:
+            started = time.perf_counter()
+        if relpath is None:
+            relpath = os.path.relpath(filename)
+        index = None
+        for prefix, patterns, indices in self.file_type_matchers:
+            match = patterns.first_match(relpath[len(prefix):])
+            if match is not None and (index is None or indices[match] < index):
+                index = indices[match]
+        if self.stats:
+            self.stats.add("file type", time.perf_counter() - started)
+        if index is None:
+            return None
+        logging.debug("File %s matches %s file type pattern" % (filename, self.file_type_prefixes[self.file_type_names[index]] + self.file_type_names[index]))
+        return self.file_type_defs[index]
+
+    """
+    Returns (initial window size, header length, needle offset) for given file type. Header length is the longest header
+    rendered from any template with main or alternative comment type of the file type, needle offset is the largest
+    distance from the start of rendered header to the first license needle in it.
+    """
+    def header_window(self, file_type_def):
+        key = (file_type_def["type"], file_type_def.get("alternative_type"))
+        window = self.header_windows.get(key)
+        if window is None:
+            length = 0
+            offset = 0
+            for type_name in filter(None, key):
+                for template in [self.config["license_template"]] + self.config["additional_templates"]:
+                    text = self.render_template(template, self.config["comment_types"][type_name], "0000-0000")
+                    text = text.encode(self.encoding, "surrogateescape")
+                    length = max(length, len(text))
+                    offset = max(offset, min([text.find(n) for n in self.license_needle_bytes if n in text], default=0))
+            window = (min(length + self.header_window_slack, self.header_window_max), length, offset)
+            self.header_windows[key] = window
+        return window
+
+    """
+    Returns size, which header window must be extended to, as header may be cut off by it, or 0 if it is large enough.
+    If license needle is found, window must fit the whole header starting at the needle. If there's no needle yet, header
+    can only follow preamble (shebang, XML declaration, blank lines) which is cut off by the window or takes up almost
+    all of it.
+    """
+    def extend_header_window(self, header, file_type_def):
+        _, length, offset = self.header_window(file_type_def)
+        positions = [position for position in map(header.find, self.license_needle_bytes) if position >= 0]
+        if positions:
+            return min(positions) - offset + length + self.header_window_slack
+        content = self.decode_header(header)
+        preamble = 0
+        for type_name in filter(None, [file_type_def["type"], file_type_def.get("alternative_type")]):
+            pattern, prefix = self.shebang_pattern(type_name)
+            end = pattern.match(content).end()
+            if not end and prefix and content.startswith(prefix):
+                # Shebang pattern doesn't match, but might match with more text
+                return 2 * len(header)
+            preamble = max(preamble, end)
+        preamble = len(content) - len(content[preamble:].lstrip())
+        if len(content) - preamble < offset + self.header_window_slack:
+            return 2 * len(header)
+        return 0
+
+    """
+    Reads header window of a file, or of its staged blob, or given number of bytes of it. Statistics are recorded to given
+    stats, i.e. of a read ahead thread, defaulting to statistics of the checker.
+    """
+    def read_header(self, filename, file_type_def=None, stats=None, size=None):
+        stats = stats or self.stats
+        if stats:
+            started = time.perf_counter()
+        blob = self.staged_blobs.get(filename)
+        if blob:
+            if self.last_blob[0] != blob:
+                self.last_blob = (blob, self.blob_reader.read(blob))
+            header = self.read_header_window(io.BytesIO(self.last_blob[1]), file_type_def, stats, size)
+        else:
+            # Unbuffered binary read is a single read() call, with no isatty() and lseek() calls done by buffered text files
+            with open(filename, "rb", buffering=0) as f:
+                header = self.read_header_window(f, file_type_def, stats, size)
+        if stats:
+            stats.add("read", time.perf_counter() - started)
+        return header
+
+    def read_header_window(self, f, file_type_def, stats=None, size=None):
+        if size is not None:
+            return f.read(size)
+        if file_type_def is None or not self.license_needles:
+            size = self.header_window_max
+        else:
+            size = self.header_window(file_type_def)[0]
+        header = f.read(size)
+        while len(header) == size < self.header_window_max:
+            size = min(self.extend_header_window(header, file_type_def), self.header_window_max)
+            if size <= len(header):
                 break
-            else:
-                logging.debug("Matching %s against %s to determine file type .... no match!" % (os.path.relpath(filename), file_pattern))
+            if stats:
+                stats.count("header window extensions")
+            header += f.read(size - len(header))
+        return header
+
+    """
+    Returns status of skipped file, if header bytes show that it is binary (contains NUL bytes) or starts with a byte
+    order mark of an encoding not compatible with ASCII, or None for text files.
+    """
+    def sniff_header(self, header):
+        for bom, status in self.unsupported_boms:
+            if header.startswith(bom):
+                return status
+        if b"\0" in header:
+            return CheckStatus.BINARY
+        return None
+
+    """
+    Decodes header bytes with configured encoding, skipping UTF-8 byte order mark and translating line endings to "\n"
+    like files opened in text mode.
+    """
+    def decode_header(self, header):
+        content = header.decode(self.encoding, "surrogateescape")
+        if self.bom and header.startswith(self.bom):
+            content = content[1:]
+        if "\r" in content:
+            content = content.replace("\r\n", "\n").replace("\r", "\n")
+        return content
+
+    """
+    Applies license pattern to content, role is one of "main", "alternative" or "additional" (used in statistics)
+    """
+    def search_pattern(self, pattern, content, role):
+        # Formatting pattern and content for debug output costs more than a failed match, do it only if it's logged
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Applying pattern:\n%s\nagainst content\n%s" % (pattern.pattern, content))
+        if not self.stats:
+            return pattern.search(content)
+        started = time.perf_counter()
+        result = pattern.search(content)
+        self.stats.add(role + " pattern", time.perf_counter() - started)
+        self.stats.count(role + " pattern attempts")
+        return result
+
+    def check_file(self, filename, fix=False, outfile=None, header=None, file_type_def=None, relpath=None):
+        return self.check_header(filename, fix, outfile, header, file_type_def, relpath)[0]
+
+    """
+    Checks a file like check_file, returning its result together with header bytes the result was taken from. These
+    extend past the header window, if header was not matched in the window, but might be cut off by it: templates allow
+    any number of blank or prefix-only lines, so header may take more bytes than the window is sized for.
+    """
+    def check_header(self, filename, fix=False, outfile=None, header=None, file_type_def=None, relpath=None):
+        if not file_type_def:
+            file_type_def = self.get_file_type_def(filename, relpath)
         if not file_type_def:
-            return self.LicenseCheckResult(0, "Filename pattern not recognized: %s" % filename)
+            return self.LicenseCheckResult(CheckStatus.NOT_RECOGNIZED, filename), header
         file_type = file_type_def["type"]
-        with open(filename) as f:
-            content = f.read(4092)
-        if not content:
-            return self.LicenseCheckResult(0, "File %s is empty" % filename)
-        logging.debug("Trying main file comment type for %s as %s" % (filename, file_type))
-        pattern = self.license_pattern_by_type[file_type][0]
-        logging.debug("Applying pattern:\n%s\nagainst content\n%s" % (pattern, content))
-        result = re.search(pattern, content)
-        if not result or not result.groupdict().get("license") and "alternative_type" in file_type_def:
-            logging.debug("Trying alternate file comment type for %s as %s" % (filename, file_type_def["alternative_type"]))
-            pattern = self.license_pattern_by_type[file_type_def["alternative_type"]][0]
-            logging.debug("Applying pattern:\n%s\nagainst content\n%s" % (pattern, content))
-            result = re.search(pattern, content)
-        if result and result.groupdict().get("license"):
-            logging.debug("Discovered groups: %s" % str(result.groupdict()))
+        if header is None:
+            header = self.read_header(filename, file_type_def)
+        if not header:
+            return self.LicenseCheckResult(CheckStatus.EMPTY, filename, file_type), header
+        status = self.sniff_header(header)
+        if status is not None:
+            return self.LicenseCheckResult(status, filename, file_type), header
+        content = self.decode_header(header)
+        if self.license_needles and not any(needle in content for needle in self.license_needles):
+            # Cheap substring search shows that none of templates can match, skip all license patterns. Shebang match is
+            # taken from the same comment type, as the last pattern which would be tried otherwise.
+            logging.debug("No license template text found in %s" % filename)
+            if self.stats:
+                self.stats.count("prefilter skips")
+            if self.config["additional_templates"] or "alternative_type" not in file_type_def:
+                shebang_type = file_type
+            else:
+                shebang_type = file_type_def["alternative_type"]
+            result = self.shebang_pattern(shebang_type)[0].search(content)
+            return self.fix_or_report(CheckStatus.NOT_DETECTED, file_type, result, fix, filename, outfile, header), header
+        match = self.match_header if self.config["engine"] == "regex" else self.match_header_chain
+        role, result = match(file_type_def, content)
+        if role not in ["main", "alternative"] and self.license_needles and self.header_window(file_type_def)[0] <= len(header) < self.header_window_max:
+            # Header fills the window, so it might be cut off by it
+            full_header = self.read_header(filename, file_type_def, size=self.header_window_max)
+            if len(full_header) > len(header):
+                if self.stats:
+                    self.stats.count("header window extensions")
+                header = full_header
+                content = self.decode_header(header)
+                role, result = match(file_type_def, content)
+        logging.debug("File %s matched %s pattern with groups: %s" % (filename, role, str(result.groupdict() if result else None)))
+        if role in ["main", "alternative"]:
             if result.groupdict().get("end_year") and result.group("end_year") != str(self.config["end_year"]) and not self.config["ignore_year"]:
-                return self.fix_or_report(1, "License is detected, but copyright year is not up to date: %s" % filename, file_type, result, fix, filename, outfile)
+                return self.fix_or_report(CheckStatus.OLD_YEAR, file_type, result, fix, filename, outfile, header), header
             if result.groupdict().get("owner") and result.group("owner") != self.config["owner"]:
-                return self.fix_or_report(1, "License is detected, but copyright owner is not current: %s" % filename, file_type, result, fix, filename, outfile)
-            return self.fix_or_report(0, "License is up to date: %s" % filename, file_type, result, fix, filename, outfile)
+                return self.fix_or_report(CheckStatus.WRONG_OWNER, file_type, result, fix, filename, outfile, header), header
+            return self.fix_or_report(CheckStatus.UP_TO_DATE, file_type, result, fix, filename, outfile, header), header
+        if role == "additional":
+            return self.fix_or_report(CheckStatus.WRONG_WORDING, file_type, result, fix, filename, outfile, header), header
+        return self.fix_or_report(CheckStatus.NOT_DETECTED, file_type, result, fix, filename, outfile, header), header
+
+"""
+Keeps checkers with compiled configuration warm between runs, serving --connect clients over a Unix domain socket.
+Request is a single JSON line {"cwd": ..., "argv": [...], "environ": {...}}. Server replies with JSON lines
+{"log": [level, message]}, {"stdout": text} or {"stderr": text}, followed by {"exit": code}. Requests are served one
+at a time, in working directory of the client. Checker is built again if any of its configuration files was created,
+modified or removed since the previous request.
+"""
+class LicenseCheckServer(object):
+
+    # Maximum number of checkers kept warm, one per distinct working directory and command line arguments
+    max_checkers = 16
+
+    # Seconds to wait for request line of a connected client, so a client which sends nothing doesn't block the server
+    request_timeout = 10
+
+    class ReplyStream(object):
+        def __init__(self, conn, name):
+            self.conn = conn
+            self.name = name
+
+        def write(self, text):
+            LicenseCheckServer.send(self.conn, {self.name: text})
+
+    class ReplyLogHandler(logging.Handler):
+        def __init__(self, conn):
+            super().__init__()
+            self.conn = conn
+
+        def emit(self, record):
+            try:
+                LicenseCheckServer.send(self.conn, {"log": [record.levelno, record.getMessage()]})
+            except Exception:
+                self.handleError(record)
+
+    def __init__(self, socket_path, parser):
+        # Requests change working directory, so a relative path would not refer to the socket after the first one
+        self.socket_path = os.path.abspath(socket_path)
+        self.parser = parser
+        self.checkers = collections.OrderedDict()
+        self.socket = None
+
+    @staticmethod
+    def send(conn, message):
+        conn.sendall(json.dumps(message).encode() + b"\n")
+
+    @staticmethod
+    def config_mtimes(license_check):
+        mtimes = []
+        for config_file in license_check.config_files:
+            try:
+                mtimes.append(os.stat(config_file).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return mtimes
+
+    """
+    Returns warm checker for given working directory and LicenseCheck arguments, building it if there is none yet or if
+    its configuration has changed.
+    """
+    def get_checker(self, cwd, kwargs):
+        # Default end year is taken when checker is built, so checkers don't outlive the year
+        key = json.dumps([cwd, datetime.datetime.now().year, kwargs], sort_keys=True)
+        entry = self.checkers.get(key)
+        if entry and entry[1] == self.config_mtimes(entry[0]):
+            self.checkers.move_to_end(key)
+            entry[0].start_run()
+            return entry[0]
+        if entry:
+            logging.info("Configuration has changed, reloading")
+        license_check = LicenseCheck(**kwargs)
+        self.checkers[key] = (license_check, self.config_mtimes(license_check))
+        self.checkers.move_to_end(key)
+        if len(self.checkers) > self.max_checkers:
+            self.checkers.popitem(last=False)
+        return license_check
+
+    def serve_forever(self):
+        import socket
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+            raise ValueError("License check server is already running on %s" % self.socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        finally:
+            probe.close()
+        if os.path.exists(self.socket_path):
+            # Stale socket of a server which didn't shut down cleanly
+            os.unlink(self.socket_path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            self.socket.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self.socket.listen()
+        logging.info("Serving license checks on %s" % self.socket_path)
+        try:
+            while self.socket:
+                try:
+                    conn, _ = self.socket.accept()
+                except OSError:
+                    if self.socket:
+                        raise
+                    break
+                with conn:
+                    self.handle(conn)
+        finally:
+            os.unlink(self.socket_path)
+
+    def shutdown(self):
+        import socket
+        listener = self.socket
+        self.socket = None
+        # Unlike close(), shutdown() wakes up accept() blocked in another thread
+        listener.shutdown(socket.SHUT_RDWR)
+        listener.close()
+
+    """
+    Parses command line arguments of a request. Usage errors and --help exit from argparse, so its output is sent to the
+    client together with its exit code, instead of shutting down the server. Returns parsed arguments and None, or None
+    and exit code if there's nothing to run.
+    """
+    def parse_args(self, conn, argv):
+        out = io.StringIO()
+        err = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                args = self.parser.parse_args(argv)
+        except SystemExit as e:
+            for name, stream in [("stdout", out), ("stderr", err)]:
+                if stream.getvalue():
+                    self.send(conn, {name: stream.getvalue()})
+            return None, e.code or 0
+        modes = [option for option, value in [("--serve", args.serve), ("--watch", args.watch), ("--merge", args.merge)] if value]
+        if modes:
+            logging.error("License check server can't run %s, run it without --connect" % " or ".join(modes))
+            return None, 2
+        return args, None
+
+    def handle(self, conn):
+        conn.settimeout(self.request_timeout)
+        try:
+            request = json.loads(conn.makefile("rb").readline())
+        except (OSError, ValueError) as e:
+            logging.warning("Failed to read request: %s" % e)
+            return
+        conn.settimeout(None)
+        cwd = os.getcwd()
+        root = logging.getLogger()
+        handlers = root.handlers
+        level = root.level
+        root.handlers = [self.ReplyLogHandler(conn)]
+        code = 2
+        try:
+            args, code = self.parse_args(conn, request["argv"])
+            if args is not None:
+                root.setLevel(get_log_level(args, request["environ"]))
+                os.chdir(request["cwd"])
+                license_check = self.get_checker(request["cwd"], get_checker_args(args))
+                code = run_scan(license_check, args, self.ReplyStream(conn, "stdout"), self.ReplyStream(conn, "stderr"))
+        except Exception as e:
+            logging.error("Failed to check files: %s" % e)
+        finally:
+            root.handlers = handlers
+            root.setLevel(level)
+            os.chdir(cwd)
+        try:
+            self.send(conn, {"exit": code})
+        except OSError as e:
+            logging.warning("Client has gone away: %s" % e)
+
+"""
+Reports changes of files in watched folders with Linux inotify, called through libc, so no extra package is needed.
+inotify is not recursive, so each folder is watched on its own, folders created later are reported to be walked and
+watched by the caller. Events are (path, relative path, kind), where kind is one of "modified", "removed",
+"dir_created", "dir_removed", or "overflow" (with no path) if kernel queue overflowed and events were lost.
+"""
+class InotifyWatcher(object):
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    # Files are reported once written and closed, or moved in (editors often save to a temporary file and rename it)
+    watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+    # Header of each event: watch descriptor, mask, cookie and length of name which follows
+    event_header_format = "iIII"
+    # Events arriving within this many seconds of each other are reported together, i.e. all files saved by a checkout
+    settle_time = 0.05
+
+    def __init__(self):
+        import ctypes
+        import struct
+        self.event_header = struct.Struct(self.event_header_format)
+        # Raises AttributeError if C library has no inotify functions (not Linux)
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Can't initialize inotify: %s" % os.strerror(ctypes.get_errno()))
+        self.dirs = {}
+        self.watches = {}
+
+    """
+    Starts watching folder (path ending with path separator). Raises OSError if it can't be watched, i.e. if limit of
+    inotify watches (fs.inotify.max_user_watches) is reached.
+    """
+    def add(self, dirprefix, relprefix):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirprefix), self.watch_mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Can't watch %s: %s" % (dirprefix, os.strerror(ctypes.get_errno())))
+        # Folder moved within watched tree keeps its watch descriptor
+        self.watches.pop(self.dirs.get(wd, (None,))[0], None)
+        self.dirs[wd] = (dirprefix, relprefix)
+        self.watches[dirprefix] = wd
+
+    """
+    Stops watching folder and its subfolders, i.e. ones moved out of watched tree, which would be reported with old paths
+    """
+    def remove(self, dirprefix):
+        for prefix in [prefix for prefix in self.watches if prefix.startswith(dirprefix)]:
+            wd = self.watches.pop(prefix)
+            del self.dirs[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    """
+    Waits up to timeout seconds for changes, returns list of events
+    """
+    def events(self, timeout):
+        import select
+        events = []
+        while select.select([self.fd], [], [], timeout if not events else self.settle_time)[0]:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+                name = data[offset + self.event_header.size:offset + self.event_header.size + length].rstrip(b"\0")
+                offset += self.event_header.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    events.append((None, None, "overflow"))
+                    continue
+                if mask & self.IN_IGNORED:
+                    # Watched folder was removed
+                    self.watches.pop(self.dirs.pop(wd, (None,))[0], None)
+                    continue
+                if wd not in self.dirs or not name:
+                    continue
+                dirprefix, relprefix = self.dirs[wd]
+                name = os.fsdecode(name)
+                if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    kind = "dir_removed" if mask & self.IN_ISDIR else "removed"
+                elif mask & self.IN_ISDIR:
+                    kind = "dir_created"
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    kind = "modified"
+                else:
+                    # New file is reported once it is written and closed
+                    continue
+                if kind == "dir_removed":
+                    self.remove(dirprefix + name + os.path.sep)
+                events.append((dirprefix + name, relprefix + name, kind))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+"""
+Fallback for InotifyWatcher where inotify is not available: lists watched folders every interval seconds and reports
+entries which were added, removed, or changed size or modification time. Reports the same events as InotifyWatcher.
+"""
+class PollingWatcher(object):
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.next_poll = time.monotonic() + interval
+        # Watched folders by path: (relative path prefix, {name: (is folder, mtime_ns, size)})
+        self.dirs = {}
+
+    def add(self, dirprefix, relprefix):
+        self.dirs[dirprefix] = (relprefix, self.list_dir(dirprefix) or {})
+
+    def remove(self, dirprefix):
+        for prefix in [prefix for prefix in self.dirs if prefix.startswith(dirprefix)]:
+            del self.dirs[prefix]
+
+    """
+    Returns entries of folder, or None if it can't be listed. Modification time of folders is not compared, as it changes
+    with their content, which is reported by listing them.
+    """
+    @staticmethod
+    def list_dir(dirprefix):
+        listing = {}
+        try:
+            with os.scandir(dirprefix) as it:
+                for entry in it:
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(entry_stat.st_mode):
+                        listing[entry.name] = (True, 0, 0)
+                    else:
+                        listing[entry.name] = (False, entry_stat.st_mtime_ns, entry_stat.st_size)
+        except OSError:
+            return None
+        return listing
+
+    def events(self, timeout):
+        wait = self.next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        self.next_poll = time.monotonic() + self.interval
+        events = []
+        for dirprefix, (relprefix, old) in list(self.dirs.items()):
+            if dirprefix not in self.dirs:
+                continue
+            new = self.list_dir(dirprefix)
+            if new is None:
+                # Removal is reported from listing of parent folder
+                self.remove(dirprefix)
+                continue
+            if new == old:
+                continue
+            self.dirs[dirprefix] = (relprefix, new)
+            for name, entry in new.items():
+                if old.get(name) != entry:
+                    if name in old and old[name][0] != entry[0]:
+                        events.append((dirprefix + name, relprefix + name, "dir_removed" if old[name][0] else "removed"))
+                    events.append((dirprefix + name, relprefix + name, "dir_created" if entry[0] else "modified"))
+            for name in old.keys() - new.keys():
+                if old[name][0]:
+                    self.remove(dirprefix + name + os.path.sep)
+                events.append((dirprefix + name, relprefix + name, "dir_removed" if old[name][0] else "removed"))
+        return events
+
+    def close(self):
+        pass
+
+"""
+Checks scan targets once, then keeps checking files as they are created or modified, until interrupted (see --watch).
+Only changed files which are not excluded are checked again, using the same checker, so feedback on a saved file takes
+a single file check. Results of all files are kept, so score of the whole tree is logged after each change. When a
+configuration or .gitignore file changes, checker is built again, with patterns compiled from the new configuration, and
+all files are checked with it.
+"""
+class LicenseWatch(object):
+
+    # Seconds to wait for changes before checking explicitly given files, which are not watched through their folders
+    wait_time = 0.5
+
+    def __init__(self, checker_args, scan_target, poll_interval=1.0, inotify=True):
+        self.checker_args = checker_args
+        self.scan_target = [scan_target] if isinstance(scan_target, str) else scan_target
+        self.poll_interval = poll_interval
+        self.inotify = inotify
+        self.license_check = None
+        self.watcher = None
+        # Result of the last check of each file, by file name
+        self.results = {}
+        # Explicitly given files, with (mtime_ns, size) when they were checked
+        self.file_targets = {}
+
+    def new_watcher(self):
+        if self.inotify:
+            try:
+                return InotifyWatcher()
+            except (OSError, AttributeError) as e:
+                logging.info("Can't use inotify (%s), polling for changes every %s s" % (e, self.poll_interval))
+        return PollingWatcher(self.poll_interval)
+
+    """
+    Builds checker from current configuration and checks all scan targets, watching walked folders
+    """
+    def start(self):
+        if self.watcher:
+            self.watcher.close()
+        self.license_check = LicenseCheck(**self.checker_args)
+        if self.license_check.config.get("git") or self.license_check.config.get("changed_since") or self.license_check.config.get("staged"):
+            raise ValueError("--watch walks directories, it can't be combined with --git, --changed-since or --staged")
+        self.watcher = self.new_watcher()
+        self.results = {}
+        self.license_check.walked_directories = []
+        for file_result in self.license_check.iter_check(self.scan_target):
+            if file_result is not None:
+                self.results[file_result.path] = file_result
+        self.file_targets = {target: self.stat_key(target) for target in self.scan_target if os.path.isfile(target)}
+        try:
+            self.watch_walked()
+        except OSError as e:
+            if not isinstance(self.watcher, InotifyWatcher):
+                raise
+            logging.info("%s, polling for changes every %s s instead" % (e, self.poll_interval))
+            self.watcher.close()
+            self.watcher = PollingWatcher(self.poll_interval)
+            self.watch_walked()
+
+    def watch_walked(self):
+        walked = self.license_check.walked_directories
+        self.license_check.walked_directories = []
+        for dirprefix, relprefix in walked:
+            self.watcher.add(dirprefix, relprefix)
+
+    @staticmethod
+    def stat_key(filename):
+        try:
+            file_stat = os.stat(filename)
+        except OSError:
+            return None
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    """
+    Handles events reported by watcher, logging results of files checked again and score of the whole tree
+    """
+    def handle(self, events):
+        license_check = self.license_check
+        changed = collections.OrderedDict()
+        for filename, relpath, kind in events:
+            name = os.path.basename(filename or "")
+            if kind == "overflow" or name == license_check.nested_config_name or os.path.abspath(filename) in license_check.config_files or \
+                    (name == ".gitignore" and license_check.config.get("respect_gitignore")):
+                logging.info("Configuration changed, checking all files again" if kind != "overflow" else
+                    "Some changes were missed, checking all files again")
+                self.start()
+                self.report()
+                return
+            changed.pop(filename, None)
+            changed[filename] = (relpath, kind)
+        for filename, (relpath, kind) in changed.items():
+            if kind in ["removed", "dir_removed"]:
+                self.forget(filename, kind == "dir_removed")
+            elif kind == "dir_created":
+                self.forget(filename, True)
+                if license_check.config_scope(os.path.dirname(relpath)).matches_exclude_relpath(relpath):
+                    continue
+                for path, path_relpath in license_check.walk_directory(filename, relpath):
+                    self.recheck(path, path_relpath)
+            else:
+                self.recheck(filename, relpath)
+        try:
+            self.watch_walked()
+        except OSError as e:
+            logging.warning(e)
+        self.report()
+
+    def forget(self, filename, is_dir=False):
+        removed = [self.results.pop(filename)] if filename in self.results else []
+        if is_dir:
+            prefix = os.path.join(filename, "")
+            removed += [self.results.pop(path) for path in [path for path in self.results if path.startswith(prefix)]]
+        for file_result in removed:
+            self.license_check.summary.remove(file_result)
+
+    """
+    Checks created or modified file again, unless it is excluded. Files not matching any file type are not read.
+    """
+    def recheck(self, filename, relpath):
+        license_check = self.license_check
+        self.forget(filename)
+        if os.path.islink(filename) or not os.path.isfile(filename):
+            return
+        if license_check.config_scope(os.path.dirname(relpath)).matches_exclude_relpath(relpath):
+            logging.debug("Not checking %s as it matches excludes pattern" % filename)
+            return
+        if license_check.config.get("respect_gitignore"):
+            absprefix = os.path.join(os.path.dirname(os.path.abspath(filename)), "")
+            chain = license_check.parent_gitignores(absprefix)
+            if license_check.load_gitignore(absprefix):
+                chain.append((absprefix, license_check.load_gitignore(absprefix)))
+            if license_check.matches_gitignore(chain, os.path.abspath(filename), False):
+                logging.debug("Not checking %s as it is ignored by git" % filename)
+                return
+        try:
+            file_result, cache_update = license_check.check_target(filename, False, relpath)
+        except OSError as e:
+            logging.warning("Can't check %s: %s" % (filename, e))
+            return
+        if cache_update:
+            license_check.result_cache.put(*cache_update)
+        file_result.log()
+        self.results[filename] = file_result
+        license_check.summary.add(file_result)
+
+    def report(self):
+        success, total = self.license_check.summary.score()
+        if total > 0:
+            logging.info("License headers score: %d%% (%d of %d file(s) failing), watching for changes" % (100.0 * success / total, total - success, total))
         else:
-            logging.debug("Main pattern did not match, trying additional patterns")
-            for pattern in self.license_pattern_by_type[file_type][1]:
-                logging.debug("Applying pattern:\n%s\nagainst content\n%s" % (pattern, content))
-                result = re.search(pattern, content)
-                if result and result.groupdict().get("license"):
-                    return self.fix_or_report(1, "License is detected, but wording is wrong: %s" % filename, file_type, result, fix, filename, outfile)
-                logging.debug("Additional pattern did not match")
-            return self.fix_or_report(1, "License is not detected: %s" % filename, file_type, result, fix, filename, outfile)
+            logging.info("No files were scanned, watching for changes")
 
-if __name__ == "__main__":
+    """
+    Watches for changes until interrupted, or until stop event is set. Returns exit code of a scan of all files.
+    """
+    def run(self, stop=None):
+        self.start()
+        self.report()
+        try:
+            while not (stop and stop.is_set()):
+                events = self.watcher.events(self.wait_time)
+                for target, key in self.file_targets.items():
+                    if self.stat_key(target) != key:
+                        self.file_targets[target] = self.stat_key(target)
+                        events.append((target, os.path.relpath(target), "modified" if self.file_targets[target] else "removed"))
+                if events:
+                    self.handle(events)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.watcher.close()
+            if self.license_check.result_cache:
+                self.license_check.result_cache.save()
+        return report_score(*self.license_check.summary.score(), self.scan_target)
+
+"""
+Forwards command line arguments to license check server listening on socket_path and replays its output. Returns exit
+code of the run, or None if server is not running, so that the caller can check files itself.
+"""
+def forward_to_server(socket_path, argv):
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError as e:
+        client.close()
+        logging.info("License check server is not available on %s (%s), checking files locally" % (socket_path, e))
+        return None
+    with client:
+        LicenseCheckServer.send(client, {"cwd": os.getcwd(), "argv": argv, "environ": {"RUNNER_DEBUG": os.environ.get("RUNNER_DEBUG")}})
+        for line in client.makefile("rb"):
+            message = json.loads(line)
+            if "log" in message:
+                logging.log(*message["log"])
+            elif "stdout" in message:
+                sys.stdout.write(message["stdout"])
+            elif "stderr" in message:
+                sys.stderr.write(message["stderr"])
+            elif "exit" in message:
+                return message["exit"]
+    logging.error("License check server closed connection before the run was complete")
+    return 2
+
+def build_arg_parser():
     parser = argparse.ArgumentParser(description='Check or fix license header in source files, with year range support')
     parser.add_argument('--fix', action='store_true', help='fix headers in source files in target directory')
+    parser.add_argument('--diff', metavar='patch_file', nargs='?', const='-', help='don\'t change files, write planned header fixes as unified diff to given file (defaults to stdout)')
+    parser.add_argument('--apply', metavar='patch_file', help='apply header fixes planned with --diff ("-" for stdin)')
     parser.add_argument('--config', metavar='config_file', help='optional config file, defaults to <scan_directory>/.license_check.yaml')
     parser.add_argument('--log-level', choices=["debug", "info", "warn"], help='log level, defaults to "info"')
     parser.add_argument('--add-exclude', metavar='add_exclude', help='additional filename exclusion patterns, comma-separated')
     parser.add_argument('--start-year', metavar='start_year', type=int, help='start year to use when new header is added (defaults to current year)')
     parser.add_argument('--end-year', metavar='end_year', type=int, help='end year to use (defaults to current year)')
     parser.add_argument('--ignore-year', action='store_true', help='ignore existing copyright year(s), only validate/fix license header wording')
+    parser.add_argument('--no-cache', action='store_true', help='don\'t use or update persistent cache of check results')
+    parser.add_argument('--jobs', metavar='jobs', type=int, help='number of parallel worker processes, 0 means one per CPU (defaults to 1)')
+    parser.add_argument('--io-depth', metavar='io_depth', type=int, help='number of files read ahead in parallel threads while files are checked, for file systems with high latency (defaults to 0)')
+    parser.add_argument('--fail-fast', action='store_true', help='stop at first file failing license check')
+    parser.add_argument('--max-failures', metavar='max_failures', type=int, help='stop after given number of files failed license check')
+    parser.add_argument('--respect-gitignore', action='store_true', help='don\'t scan files and directories ignored by .gitignore files')
+    parser.add_argument('--git', action='store_true', help='scan only files tracked by git, instead of walking directories')
+    parser.add_argument('--changed-since', metavar='ref', help='scan only files added or modified since given git ref (i.e. PR base branch)')
+    parser.add_argument('--staged', action='store_true', help='check content of files staged in git index (i.e. in pre-commit hook), stage them again after --fix')
+    parser.add_argument('--stats', '--profile', action='store_true', help='print time per scan phase, counters and slowest files to stderr')
+    parser.add_argument('--stats-json', metavar='stats_file', help='write scan statistics as JSON to given file ("-" for stdout)')
+    parser.add_argument('--shard', metavar='i/N', type=parse_shard, help='check only i-th of N parts of files (i from 1 to N), split by hash of file path')
+    parser.add_argument('--results-out', metavar='results_file', help='write score, counts and failing files to given file, to be combined with --merge')
+    parser.add_argument('--merge', action='store_true', help='combine results files of shards given as arguments (written by --results-out), instead of scanning')
+    parser.add_argument('--watch', action='store_true', help='after checking all files, keep checking files as they are created or modified, until interrupted')
+    parser.add_argument('--serve', metavar='socket', help='keep compiled configuration in memory and check files for --connect clients on given Unix socket')
+    parser.add_argument('--connect', metavar='socket', help='check files with a server started by --serve on given Unix socket, if it is running')
     parser.add_argument('scan_target', nargs='*', default=os.path.curdir, help='directories and individual files to scan (defaults to current directory)')
-    args = parser.parse_args()
+    return parser
+
+def parse_shard(value):
+    match = re.match(r'^(\d+)/(\d+)$', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError("shard must be i/N, with i from 1 to N: %s" % value)
+    return [int(match.group(1)), int(match.group(2))]
+
+def get_log_level(args, environ):
     if args.log_level == "warn":
-        log_level = logging.WARNING
+        return logging.WARNING
     elif args.log_level == "debug":
-        log_level = logging.DEBUG
-    elif args.log_level is None and os.environ.get("RUNNER_DEBUG") == "1":
-        log_level = logging.DEBUG
+        return logging.DEBUG
+    elif args.log_level is None and environ.get("RUNNER_DEBUG") == "1":
+        return logging.DEBUG
     else:
-        log_level = logging.INFO
-    logging.basicConfig(format="[%(levelname)s] %(message)s", level=log_level)
-    license_check = LicenseCheck(config_override=args.config, add_exclude_cli=args.add_exclude,
-        start_year=args.start_year, end_year=args.end_year, ignore_year=args.ignore_year)
-    result = license_check.check(args.scan_target, fix=args.fix)
+        return logging.INFO
+
+def get_checker_args(args):
+    return dict(config_override=args.config, add_exclude_cli=args.add_exclude,
+        start_year=args.start_year, end_year=args.end_year, ignore_year=args.ignore_year, jobs=args.jobs, io_depth=args.io_depth,
+        cache=not args.no_cache, stats=args.stats or args.stats_json, git=args.git, changed_since=args.changed_since, staged=args.staged, diff=bool(args.diff), shard=args.shard,
+        **({"respect_gitignore": True} if args.respect_gitignore else {}))
+
+"""
+Runs the scan requested by command line arguments, writing statistics to out and err streams. Returns exit code.
+"""
+def run_scan(license_check, args, out, err):
+    if args.apply:
+        with (open(args.apply) if args.apply != "-" else contextlib.nullcontext(sys.stdin)) as f:
+            return 1 if license_check.apply_patch(f) else 0
+    patches = []
+    failures = []
+    try:
+        for file_result in license_check.iter_check(args.scan_target, fix=args.fix or bool(args.diff), max_failures=1 if args.fail_fast else args.max_failures):
+            if file_result is not None and file_result.patch:
+                patches.append(file_result.patch)
+            if args.results_out and file_result is not None and file_result.code > 0:
+                failures.append([int(file_result.status), file_result.path])
+    except ValueError as e:
+        logging.error(e)
+        return 2
+    if args.results_out:
+        with open(args.results_out, "w") as f:
+            json.dump({"version": results_version, "shard": license_check.config.get("shard") or [1, 1], "fingerprint": license_check.fingerprint,
+                "fix": bool(args.fix or args.diff), "scan_target": args.scan_target, "summary": license_check.summary.report(), "failures": failures},
+                f, separators=(",", ":"))
+    if args.diff:
+        # Patch is written once all files are planned, so that a failed scan leaves no partial patch
+        with (open(args.diff, "w") if args.diff != "-" else contextlib.nullcontext(out)) as f:
+            f.write("".join(patches))
+        logging.info("Planned fixes of %d file(s), apply them with --apply" % len(patches))
+        return 0
+    if args.stats:
+        err.write(license_check.stats.format_report())
+        err.write(license_check.summary.format_report(license_check.stats.top))
+    if args.stats_json:
+        with (open(args.stats_json, "w") if args.stats_json != "-" else contextlib.nullcontext(out)) as f:
+            json.dump(dict(license_check.stats.report(), results=license_check.summary.report()), f, indent=2)
+            f.write("\n")
     if not args.fix:
-        success = len(list(filter(lambda x: x.code == 0, result)))
-        total = len(result)
-        if total > 0:
-            logging.info("License headers score: %d%%" % (100.0 * success / total))
-        else:
-            logging.info("No files were scanned")
-        if success < total:
-            logging.info("Not all files have proper license headers. You may fix them by running:")
-            logging.info("")
-            logging.info("    docker run -it --rm -v $(pwd):/github/workspace /us-docker.pkg.dev/csm-release/csm-docker/stable/license-checker --fix %s" % " ".join(args.scan_target))
-            logging.info("")
-            logging.info("Please refer to https://github.com/Cray-HPE/license-checker for more details.")
-        sys.exit(1 if success < total else 0)
+        return report_score(*license_check.summary.score(), args.scan_target)
+    return 0
+
+"""
+Logs license headers score and hint how to fix files, returns exit code of the scan
+"""
+def report_score(success, total, scan_target):
+    if total > 0:
+        logging.info("License headers score: %d%%" % (100.0 * success / total))
+    else:
+        logging.info("No files were scanned")
+    if success < total:
+        logging.info("Not all files have proper license headers. You may fix them by running:")
+        logging.info("")
+        logging.info("    docker run -it --rm -v $(pwd):/github/workspace /us-docker.pkg.dev/csm-release/csm-docker/stable/license-checker --fix %s" % " ".join(scan_target))
+        logging.info("")
+        logging.info("Please refer to https://github.com/Cray-HPE/license-checker for more details.")
+    return 1 if success < total else 0
+
+"""
+Combines results files written by --results-out in shards of the same scan, logging failing files and score the same way
+as a scan of all files. Returns exit code, which is the same as of a scan of all files, or 2 if results don't cover all
+shards or come from scans with different configuration.
+"""
+def merge_results(results_files):
+    summary = ResultSummary()
+    failures = []
+    shards = {}
+    try:
+        for results_file in results_files:
+            with open(results_file) as f:
+                results = json.load(f)
+            if results.get("version") != results_version:
+                raise ValueError("Results file %s is not written by this version of license checker" % results_file)
+            index, count = results["shard"]
+            first = next(iter(shards.values()), results)
+            if results["fingerprint"] != first["fingerprint"] or [count, results["fix"]] != [first["shard"][1], first["fix"]]:
+                raise ValueError("Results file %s comes from a different scan than %s" % (results_file, results_files[0]))
+            if index in shards:
+                raise ValueError("Results of shard %d/%d are given more than once" % (index, count))
+            shards[index] = results
+            summary.merge_report(results["summary"])
+            failures += results["failures"]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.error("Can't merge results: %s" % e)
+        return 2
+    if not shards:
+        logging.error("No results files to merge")
+        return 2
+    first = next(iter(shards.values()))
+    missing = [index for index in range(1, first["shard"][1] + 1) if index not in shards]
+    if missing:
+        logging.error("Missing results of shard(s) %s" % ", ".join("%d/%d" % (index, first["shard"][1]) for index in missing))
+        return 2
+    for status, path in sorted(failures, key=lambda x: x[1]):
+        logging.warning(CheckStatus(status).message % path)
+    logging.info("Merged results of %d shard(s)" % len(shards))
+    if first["fix"]:
+        return 0
+    return report_score(*summary.score(), first["scan_target"])
+
+if __name__ == "__main__":
+    parser = build_arg_parser()
+    args = parser.parse_args()
+    logging.basicConfig(format="[%(levelname)s] %(message)s", level=get_log_level(args, os.environ))
+    if args.merge:
+        # Results files are combined without configuration, so neither checker nor server is needed
+        sys.exit(merge_results(args.scan_target if isinstance(args.scan_target, list) else []))
+    if args.connect:
+        code = forward_to_server(args.connect, sys.argv[1:])
+        if code is not None:
+            sys.exit(code)
+    if args.serve:
+        import signal
+        server = LicenseCheckServer(args.serve, parser)
+        # Exit through finally blocks, so that socket file is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.get_checker(os.getcwd(), get_checker_args(args))
+            server.serve_forever()
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(2)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    if args.watch:
+        if args.fix or args.diff or args.apply:
+            parser.error("--watch only checks files, it can't be combined with --fix, --diff or --apply")
+        try:
+            sys.exit(LicenseWatch(get_checker_args(args), args.scan_target).run())
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(2)
+    license_check = LicenseCheck(**get_checker_args(args))
+    sys.exit(run_scan(license_check, args, sys.stdout, sys.stderr))
@@ -0,0 +1,592 @@
+#!/usr/bin/env python3
+#
+# MIT License
+#
+# (C) Copyright 2026 Hewlett Packard Enterprise Development LP
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+import argparse
+import fnmatch
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import license_check
+
+"""
+Implementation of exclusion checks as it was before FnmatchSet was introduced: every path is matched against each
+exclusion pattern with fnmatch, for every parent folder of the path, with results kept in unbounded dict.
+"""
+class LegacyExclusionCheck(license_check.LicenseCheck):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.exclusion_cache = {}
+
+    def matches_exclude_path(self, path):
+        if path in self.exclusion_cache:
+            logging.debug("Found exclusion check result for \"%s\" in cache as %s" % (path, str(self.exclusion_cache[path])))
+            return self.exclusion_cache[path]
+        for p in self.config["exclude"]:
+            if fnmatch.fnmatch(path, p):
+                logging.debug("Matching \"%s\" against \"%s\" .... matched!" % (path, p))
+                self.exclusion_cache[path] = True
+                return True
+            else:
+                logging.debug("Matching \"%s\" against \"%s\" .... no match!" % (path, p))
+        self.exclusion_cache[path] = False
+        return False
+
+    def iter_targets(self, scan_targets):
+        for dirname, subdirs, filenames in os.walk(scan_targets):
+            for subdir in subdirs.copy():
+                if self.matches_exclude(dirname + os.path.sep + subdir):
+                    subdirs.remove(subdir)
+            for filename in filenames:
+                filename = dirname + os.path.sep + filename
+                if not os.path.islink(filename) and not self.matches_exclude(filename):
+                    yield filename
+
+"""
+Creates a tree of empty files, depth levels deep, with fanout subfolders per folder and files_per_dir files in each.
+"""
+def generate_deep_tree(root, depth, fanout, files_per_dir):
+    extensions = [".go", ".py", ".yaml", ".md", ".json", ".sh", ".txt", ".xml"]
+    count = 0
+    dirs = [root]
+    for level in range(depth):
+        next_dirs = []
+        for dirname in dirs:
+            for i in range(files_per_dir):
+                with open(os.path.join(dirname, "file%d%s" % (i, extensions[(i + level) % len(extensions)])), "w"):
+                    count += 1
+            if len(next_dirs) < fanout ** 3:
+                for i in range(fanout):
+                    subdir = os.path.join(dirname, "level%d_%d" % (level, i))
+                    os.mkdir(subdir)
+                    next_dirs.append(subdir)
+        dirs = next_dirs or dirs[:1]
+    return count
+
+"""
+Exclusion patterns used by the benchmark: default ones, plus generated patterns of all common shapes.
+"""
+def exclusion_patterns(count):
+    patterns = []
+    for i in range(count):
+        shape = i % 4
+        if shape == 0:
+            patterns.append("*.ext%d" % i)
+        elif shape == 1:
+            patterns.append("*/generated%d" % i)
+        elif shape == 2:
+            patterns.append("out%d" % i)
+        else:
+            patterns.append("*/cache%d/*.tmp" % i)
+    return patterns
+
+"""
+Creates files of various recognized types without license header, with some source-like content.
+"""
+def generate_no_header_tree(root, count):
+    extensions = [".go", ".py", ".yaml", ".sh", ".xml", ".java", ".js"]
+    body = "".join("line %d of generated source, no license header here\n" % i for i in range(200))
+    for i in range(count):
+        with open(os.path.join(root, "file%d%s" % (i, extensions[i % len(extensions)])), "w") as f:
+            f.write(body)
+
+def timed(func):
+    started = time.perf_counter()
+    result = func()
+    return time.perf_counter() - started, result
+
+def bench_exclude(args):
+    root = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        count = generate_deep_tree(root, args.depth, 3, args.files_per_dir)
+        os.chdir(root)
+        kwargs = {"add_exclude": exclusion_patterns(args.patterns)}
+        legacy = LegacyExclusionCheck(**kwargs)
+        compiled = license_check.LicenseCheck(**kwargs)
+        print("Tree: %d files, depth %d, %d exclusion patterns" % (count, args.depth, len(compiled.config["exclude"])))
+        legacy_time, legacy_result = timed(lambda: list(legacy.iter_targets(os.curdir)))
+        compiled_time, compiled_result = timed(lambda: list(compiled.iter_targets(os.curdir)))
+        if legacy_result != compiled_result:
+            raise AssertionError("Exclusion results differ between legacy and compiled matcher")
+        print("legacy fnmatch loop: %8.3f s" % legacy_time)
+        print("compiled matcher:    %8.3f s (%.1fx)" % (compiled_time, legacy_time / compiled_time))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+def bench_no_header(args):
+    root = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        generate_no_header_tree(root, args.files)
+        os.chdir(root)
+        prefiltered = license_check.LicenseCheck()
+        regex_only = license_check.LicenseCheck()
+        regex_only.license_needles = []
+        print("Tree: %d files without license header" % args.files)
+        regex_time, regex_result = timed(lambda: regex_only.check(os.curdir))
+        prefilter_time, prefilter_result = timed(lambda: prefiltered.check(os.curdir))
+        if [(r.code, r.message) for r in regex_result] != [(r.code, r.message) for r in prefilter_result]:
+            raise AssertionError("Results differ with and without prefilter")
+        print("full check, regex only:           %8.3f s" % regex_time)
+        print("full check, literal prefilter:    %8.3f s (%.1fx)" % (prefilter_time, regex_time / prefilter_time))
+        contents = {}
+        for filename in os.listdir(os.curdir):
+            contents[filename] = regex_only.read_header(filename, regex_only.get_file_type_def(filename))
+        regex_time, _ = timed(lambda: [regex_only.check_file(k, header=v) for k, v in contents.items()])
+        prefilter_time, _ = timed(lambda: [prefiltered.check_file(k, header=v) for k, v in contents.items()])
+        print("matching only, regex only:        %8.3f s" % regex_time)
+        print("matching only, literal prefilter: %8.3f s (%.1fx)" % (prefilter_time, regex_time / prefilter_time))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+"""
+Matching as it was before patterns were combined: main, alternative and each additional pattern are applied one by one.
+"""
+class ChainedMatching(license_check.LicenseCheck):
+
+    def match_header(self, file_type_def, content):
+        return self.match_header_chain(file_type_def, content)
+
+"""
+Creates files mostly without license header: some have no copyright text at all, some have a foreign copyright notice
+(which passes literal prefilter, so all patterns are tried), and a few have a valid header.
+"""
+def generate_mostly_no_header_tree(root, count):
+    checker = license_check.LicenseCheck()
+    extensions = [".go", ".py", ".yaml", ".sh", ".xml", ".java", ".js"]
+    body = "".join("line %d of generated source, no license header here\n" % i for i in range(200))
+    for i in range(count):
+        filename = os.path.join(root, "file%d%s" % (i, extensions[i % len(extensions)]))
+        type_def = checker.config["comment_types"][checker.get_file_type_def(filename)["type"]]
+        if i % 10 == 0:
+            content = render_header(type_def, checker.config["license_template"], str(checker.config["end_year"]), checker.config["owner"])
+        elif i % 2:
+            content = render_header(type_def, "Copyright (c) 2019 Example Authors. All rights reserved.", "", "")
+        else:
+            content = ""
+        with open(filename, "w") as f:
+            f.write(content + body)
+
+def bench_combined(args):
+    root = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        generate_mostly_no_header_tree(root, args.files)
+        os.chdir(root)
+        chained = ChainedMatching()
+        combined = license_check.LicenseCheck()
+        print("Tree: %d files, 10%% with license header, 45%% with foreign copyright notice" % args.files)
+        chained_time, chained_result = timed(lambda: chained.check(os.curdir))
+        combined_time, combined_result = timed(lambda: combined.check(os.curdir))
+        if [(r.code, r.message) for r in chained_result] != [(r.code, r.message) for r in combined_result]:
+            raise AssertionError("Results differ between chained and combined patterns")
+        print("full check, pattern by pattern:    %8.3f s" % chained_time)
+        print("full check, combined pattern:      %8.3f s (%.1fx)" % (combined_time, chained_time / combined_time))
+        contents = {}
+        for filename in os.listdir(os.curdir):
+            contents[filename] = combined.read_header(filename, combined.get_file_type_def(filename))
+        for name, needles in [("no prefilter", []), ("literal prefilter", combined.license_needles)]:
+            chained.license_needles = combined.license_needles = needles
+            chained_time, _ = timed(lambda: [chained.check_file(k, header=v) for k, v in contents.items()])
+            combined_time, _ = timed(lambda: [combined.check_file(k, header=v) for k, v in contents.items()])
+            print("matching only, %-18s pattern by pattern: %8.3f s, combined: %8.3f s (%.1fx)" % (name + ",", chained_time,
+                combined_time, chained_time / combined_time))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+"""
+Inputs which make generated regex backtrack: runs of blank lines, lines with line prefix only, and prefix lines padded
+with spaces, filling whole header window, for each comment type.
+"""
+def adversarial_inputs(type_def, size):
+    prefix = type_def["line_prefix"]
+    inputs = {
+        "blank lines": type_def["insert_before"] + "\n" * size,
+        "prefix-only lines": type_def["insert_before"] + (prefix.rstrip() + "\n") * (size // (len(prefix.rstrip()) + 1)),
+        "padded prefix lines": type_def["insert_before"] + (prefix + " " * 8 + "\n") * (size // (len(prefix) + 9)),
+        "blank and prefix lines": type_def["insert_before"] + (prefix + "\n\n") * (size // (len(prefix) + 2)),
+    }
+    return {k: v[:size] + "x" for k, v in inputs.items()}
+
+def bench_adversarial(args):
+    regex = license_check.LicenseCheck()
+    parser = license_check.LicenseCheck(engine="parser")
+    print("%-18s %-24s %12s %12s" % ("comment type", "input", "regex, ms", "parser, ms"))
+    for type_name, type_def in regex.config["comment_types"].items():
+        for input_name, content in adversarial_inputs(type_def, args.size).items():
+            regex_pattern = regex.license_patterns(type_name)[0]
+            parser_pattern = parser.license_patterns(type_name)[0]
+            regex_time, regex_match = timed(lambda: regex_pattern.search(content))
+            parser_time, parser_match = timed(lambda: parser_pattern.search(content))
+            if regex_match.groupdict() != parser_match.groupdict():
+                raise AssertionError("Engines disagree on %s for %s" % (input_name, type_name))
+            print("%-18s %-24s %12.3f %12.3f" % (type_name, input_name, regex_time * 1000, parser_time * 1000))
+
+"""
+Header states of generated files, in proportions used by synthetic repository generator.
+"""
+header_states = {
+    "valid": 40,
+    "old year": 20,
+    "wrong owner": 5,
+    "additional template": 10,
+    "no header": 15,
+    "shebang or declaration": 10,
+}
+
+shebangs = {
+    "shell_or_python": "#!/usr/bin/env python3\n",
+    "yaml": "#!/usr/bin/env ansible-playbook\n",
+    "xml": "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n",
+    "html": "<!DOCTYPE html>\n",
+}
+
+"""
+Renders license header for given comment type the same way LicenseCheck.license_template() does, but for any template
+text, year and owner.
+"""
+def render_header(type_def, text, year, owner):
+    text = text.strip()
+    if type_def["line_prefix"]:
+        text = "\n" + text + "\n"
+        text = "\n".join((type_def["line_prefix"] + line).rstrip() for line in text.split("\n"))
+    return type_def["insert_before"] + text.replace("[owner]", owner).replace("[year]", year) + "\n" + type_def["insert_after"]
+
+"""
+Turns file type pattern into relative file name for i-th generated file, or returns None for patterns which name a
+single file (like LICENSE), as those can't be repeated in the same folder.
+"""
+def file_name_for_pattern(pattern, i):
+    if "*" not in pattern.replace("*/", "", 1):
+        return None
+    if pattern.startswith("*/"):
+        pattern = pattern[2:]
+    return pattern.replace("*", "file%d" % i, 1).replace("*", "")
+
+"""
+Creates reproducible synthetic repository: files of all types from file_types, spread over folders up to given depth,
+with header states mixed according to header_states. Returns dict of number of files per header state.
+"""
+def generate_repository(root, files, depth, seed=0, config=None):
+    checker = license_check.LicenseCheck(**(config or {}))
+    rng = random.Random(seed)
+    year = checker.config["end_year"]
+    owner = checker.config["owner"]
+    patterns = [p for p in checker.config["file_types"] if file_name_for_pattern(p, 0)]
+    states = list(header_states)
+    weights = [header_states[s] for s in states]
+    body = "".join("generated line %d of source file, just some content to read\n" % i for i in range(60))
+    dirs = [root]
+    counts = dict.fromkeys(states, 0)
+    for i in range(files):
+        if len(dirs) < depth * 4 and rng.random() < 0.1:
+            parent = rng.choice(dirs)
+            if parent.count(os.path.sep) - root.count(os.path.sep) < depth:
+                dirs.append(os.path.join(parent, "dir%d" % i))
+                os.makedirs(dirs[-1])
+        pattern = rng.choice(patterns)
+        type_def_name = checker.config["file_types"][pattern]["type"]
+        type_def = checker.config["comment_types"][type_def_name]
+        state = rng.choices(states, weights)[0]
+        counts[state] += 1
+        content = ""
+        if state == "valid":
+            content = render_header(type_def, checker.config["license_template"], str(year), owner)
+        elif state == "old year":
+            content = render_header(type_def, checker.config["license_template"], "%d-%d" % (year - 5, year - 2), owner)
+        elif state == "wrong owner":
+            content = render_header(type_def, checker.config["license_template"], str(year), "Example Corporation")
+        elif state == "additional template":
+            content = render_header(type_def, checker.config["additional_templates"][0], str(year), owner)
+        elif state == "shebang or declaration":
+            content = shebangs.get(type_def_name, "") + render_header(type_def, checker.config["license_template"], str(year), owner)
+        # Patterns like "Jenkinsfile*" match only in top level folder
+        filename = os.path.join(rng.choice(dirs) if pattern.startswith("*") else root, file_name_for_pattern(pattern, i))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as f:
+            f.write(content + body)
+    return counts
+
+"""
+Runs single scenario in current process and prints its measurements as JSON. Called by bench_suite() in a separate
+process, so peak RSS of every scenario is measured independently.
+"""
+def run_scenario(args):
+    checker = license_check.LicenseCheck(cache=bool(args.cache_file), cache_file=args.cache_file, jobs=args.jobs)
+    os.chdir(args.root)
+    seconds, results = timed(lambda: sum(1 for _ in checker.iter_check(os.curdir, fix=args.fix)))
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    json.dump({"seconds": seconds, "files": results, "max_rss_kb": max_rss}, sys.stdout)
+
+def spawn_scenario(root, jobs, fix=False, cache_file=None):
+    command = [sys.executable, os.path.abspath(__file__), "run-scenario", "--root", root, "--jobs", str(jobs)]
+    if fix:
+        command.append("--fix")
+    if cache_file:
+        command += ["--cache-file", cache_file]
+    return json.loads(subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout)
+
+"""
+Scenarios of the suite: check without cache (cold) and with populated cache (warm), fix of a fresh copy of the tree.
+Each one is repeated and the best run is reported, to reduce noise.
+"""
+def run_suite(root, workdir, jobs, repeat):
+    results = {}
+    cache_file = os.path.join(workdir, "cache")
+
+    def best(name, run):
+        runs = [run() for _ in range(repeat)]
+        fastest = min(runs, key=lambda r: r["seconds"])
+        results[name] = {
+            "files": fastest["files"],
+            "files_per_second": fastest["files"] / fastest["seconds"],
+            "max_rss_kb": max(r["max_rss_kb"] for r in runs),
+        }
+
+    def cold_check():
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        return spawn_scenario(root, jobs, cache_file=cache_file)
+
+    def fix():
+        copy = os.path.join(workdir, "fix")
+        shutil.rmtree(copy, ignore_errors=True)
+        shutil.copytree(root, copy)
+        return spawn_scenario(copy, jobs, fix=True)
+
+    best("check, no cache", lambda: spawn_scenario(root, jobs))
+    best("check, cold cache", cold_check)
+    spawn_scenario(root, jobs, cache_file=cache_file)
+    best("check, warm cache", lambda: spawn_scenario(root, jobs, cache_file=cache_file))
+    best("fix", fix)
+    return results
+
+"""
+Compares results with baseline, returns list of regressions exceeding threshold (relative change, i.e. 0.1 for 10%).
+"""
+def compare_with_baseline(results, baseline, threshold):
+    regressions = []
+    print("%-20s %14s %14s %8s %12s %12s %8s" % ("scenario", "files/s", "baseline", "change", "peak RSS, MB", "baseline", "change"))
+    for name, result in results.items():
+        base = baseline["scenarios"].get(name)
+        if not base:
+            print("%-20s %14.1f %14s" % (name, result["files_per_second"], "-"))
+            continue
+        speed_change = result["files_per_second"] / base["files_per_second"] - 1
+        rss_change = result["max_rss_kb"] / base["max_rss_kb"] - 1
+        print("%-20s %14.1f %14.1f %+7.1f%% %12.1f %12.1f %+7.1f%%" % (name, result["files_per_second"], base["files_per_second"],
+            speed_change * 100, result["max_rss_kb"] / 1024, base["max_rss_kb"] / 1024, rss_change * 100))
+        if speed_change < -threshold:
+            regressions.append("%s: throughput dropped by %.1f%%" % (name, -speed_change * 100))
+        if rss_change > threshold:
+            regressions.append("%s: peak RSS grew by %.1f%%" % (name, rss_change * 100))
+    return regressions
+
+def bench_suite(args):
+    workdir = tempfile.mkdtemp()
+    try:
+        root = os.path.join(workdir, "repo")
+        os.mkdir(root)
+        counts = generate_repository(root, args.files, args.depth, args.seed)
+        print("Tree: %d files, depth %d, seed %d (%s)" % (args.files, args.depth, args.seed,
+            ", ".join("%s: %d" % item for item in counts.items())))
+        results = run_suite(root, workdir, args.jobs, args.repeat)
+    finally:
+        shutil.rmtree(workdir)
+    parameters = {"files": args.files, "depth": args.depth, "seed": args.seed, "jobs": args.jobs}
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("parameters") != parameters:
+            print("Baseline %s was recorded with different parameters %s, ignoring it" % (args.baseline, baseline.get("parameters")))
+            baseline = None
+    regressions = compare_with_baseline(results, baseline or {"scenarios": {}}, args.threshold)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"parameters": parameters, "scenarios": results}, f, indent=2)
+            f.write("\n")
+        print("Baseline saved to %s" % args.save_baseline)
+    for regression in regressions:
+        print("REGRESSION %s (threshold %.1f%%)" % (regression, args.threshold * 100))
+    if regressions:
+        sys.exit(1)
+
+"""
+Directory walk as it was before the scandir based walker: os.walk(), islink() call for every file, and relative path of
+every file recomputed when resolving its type.
+"""
+class LegacyWalk(license_check.LicenseCheck):
+
+    def iter_target_paths(self, scan_targets, fix=False):
+        for dirname, subdirs, filenames in os.walk(scan_targets):
+            reldir = os.path.relpath(dirname)
+            relprefix = "" if reldir == os.path.curdir else reldir + os.path.sep
+            for subdir in subdirs.copy():
+                if self.matches_exclude_path(relprefix + subdir):
+                    subdirs.remove(subdir)
+            for filename in filenames:
+                relpath = relprefix + filename
+                filename = dirname + os.path.sep + filename
+                if not os.path.islink(filename) and not self.matches_exclude_path(relpath):
+                    # Relative path is recomputed from file name, as the checker did for each file before
+                    yield filename, os.path.relpath(filename)
+
+"""
+Runs directory listing or check in current process and prints number of files as JSON. With --audit, counts file system
+operations done after checker is initialized, from Python side, for systems without strace: opening files and listing
+directories (via audit hooks), os.stat(), os.lstat() and os.getcwd() calls (via wrappers). Calls done internally by
+interpreter, like fstat() on open, are not visible this way.
+"""
+def run_syscall_scenario(args):
+    checker = (LegacyWalk if args.walker == "legacy" else license_check.LicenseCheck)(cache=False)
+    os.chdir(args.root)
+    counts = {}
+    if args.audit:
+        events = {"open": "open", "os.scandir": "scandir", "os.listdir": "listdir"}
+
+        def hook(event, event_args):
+            if event in events:
+                counts[events[event]] = counts.get(events[event], 0) + 1
+        sys.addaudithook(hook)
+        for name in ["stat", "lstat", "getcwd"]:
+            def counted(*call_args, name=name, func=getattr(os, name), **kwargs):
+                counts[name] = counts.get(name, 0) + 1
+                return func(*call_args, **kwargs)
+            setattr(os, name, counted)
+    if args.mode == "list":
+        files = sum(1 for _ in checker.iter_targets(os.curdir))
+    else:
+        files = sum(1 for _ in checker.iter_check(os.curdir))
+    json.dump({"files": files, "counts": dict(counts)}, sys.stdout)
+
+"""
+Counts system calls of a scenario with strace, excluding calls made by interpreter startup and checker initialization,
+as measured on an empty folder.
+"""
+def strace_counts(strace, root, empty, walker, mode):
+    counts = {}
+    files = 0
+    for sign, folder in [(1, root), (-1, empty)]:
+        with tempfile.NamedTemporaryFile("r") as output:
+            command = [strace, "-f", "-c", "-o", output.name, sys.executable, os.path.abspath(__file__), "run-syscalls",
+                "--root", folder, "--walker", walker, "--mode", mode]
+            result = json.loads(subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout)
+            files = files or result["files"]
+            for line in output:
+                # Summary lines are "% time, seconds, usecs/call, calls, [errors], syscall"
+                fields = line.split()
+                if len(fields) in [5, 6] and fields[3].isdigit() and fields[-1] != "total":
+                    counts[fields[-1]] = counts.get(fields[-1], 0) + sign * int(fields[3])
+    return files, counts
+
+def audit_counts(root, walker, mode):
+    command = [sys.executable, os.path.abspath(__file__), "run-syscalls", "--root", root, "--walker", walker, "--mode", mode, "--audit"]
+    result = json.loads(subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout)
+    return result["files"], result["counts"]
+
+def bench_syscalls(args):
+    workdir = tempfile.mkdtemp()
+    try:
+        root = os.path.join(workdir, "repo")
+        empty = os.path.join(workdir, "empty")
+        os.mkdir(root)
+        os.mkdir(empty)
+        generate_repository(root, args.files, args.depth, args.seed)
+        strace = shutil.which("strace")
+        if strace:
+            print("Tree: %d files, system calls counted with strace" % args.files)
+        else:
+            print("Tree: %d files, strace not found, counting Python level file system calls" % args.files)
+        for walker in ["legacy", "scandir"]:
+            for mode in ["list", "check"]:
+                if strace:
+                    files, counts = strace_counts(strace, root, empty, walker, mode)
+                else:
+                    files, counts = audit_counts(root, walker, mode)
+                counts = sorted(((v, k) for k, v in counts.items() if v > 0), reverse=True)
+                print("%-8s %-6s %6d files, %6.2f calls per file: %s" % (walker, mode, files, sum(v for v, k in counts) / files,
+                    ", ".join("%s %.2f" % (k, v / files) for v, k in counts[:args.top])))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Performance benchmarks for license checker')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    exclude_parser = subparsers.add_parser('exclude', help='exclusion matching while walking a deep tree')
+    exclude_parser.add_argument('--depth', type=int, default=10, help='depth of generated tree')
+    exclude_parser.add_argument('--files-per-dir', type=int, default=20, help='number of files in each folder')
+    exclude_parser.add_argument('--patterns', type=int, default=120, help='number of generated exclusion patterns')
+    exclude_parser.set_defaults(func=bench_exclude)
+    no_header_parser = subparsers.add_parser('no-header', help='checking files without license header')
+    no_header_parser.add_argument('--files', type=int, default=5000, help='number of generated files')
+    no_header_parser.set_defaults(func=bench_no_header)
+    combined_parser = subparsers.add_parser('combined', help='single combined pattern against patterns tried one by one, on files mostly without license header')
+    combined_parser.add_argument('--files', type=int, default=5000, help='number of generated files')
+    combined_parser.set_defaults(func=bench_combined)
+    adversarial_parser = subparsers.add_parser('adversarial', help='worst case inputs for regex and parser engines')
+    adversarial_parser.add_argument('--size', type=int, default=4092, help='size of input')
+    adversarial_parser.set_defaults(func=bench_adversarial)
+    suite_parser = subparsers.add_parser('suite', help='check and fix throughput and peak RSS on synthetic repository, compared with baseline')
+    suite_parser.add_argument('--files', type=int, default=20000, help='number of generated files')
+    suite_parser.add_argument('--depth', type=int, default=6, help='maximum folder depth')
+    suite_parser.add_argument('--seed', type=int, default=0, help='random seed of generated repository')
+    suite_parser.add_argument('--jobs', type=int, default=1, help='number of worker processes')
+    suite_parser.add_argument('--repeat', type=int, default=3, help='number of runs of each scenario, best one is reported')
+    suite_parser.add_argument('--baseline', default='license_check_bench.json', help='baseline to compare with, if exists')
+    suite_parser.add_argument('--save-baseline', metavar='baseline_file', help='store results as new baseline')
+    suite_parser.add_argument('--threshold', type=float, default=0.15, help='allowed relative regression, i.e. 0.15 for 15%%')
+    suite_parser.set_defaults(func=bench_suite)
+    syscalls_parser = subparsers.add_parser('syscalls', help='system calls per file for legacy and scandir based directory walk')
+    syscalls_parser.add_argument('--files', type=int, default=5000, help='number of generated files')
+    syscalls_parser.add_argument('--depth', type=int, default=6, help='maximum folder depth')
+    syscalls_parser.add_argument('--seed', type=int, default=0, help='random seed of generated repository')
+    syscalls_parser.add_argument('--top', type=int, default=8, help='number of most frequent system calls to show')
+    syscalls_parser.set_defaults(func=bench_syscalls)
+    run_syscalls_parser = subparsers.add_parser('run-syscalls', help=argparse.SUPPRESS)
+    run_syscalls_parser.add_argument('--root', required=True)
+    run_syscalls_parser.add_argument('--walker', choices=['legacy', 'scandir'], default='scandir')
+    run_syscalls_parser.add_argument('--mode', choices=['list', 'check'], default='check')
+    run_syscalls_parser.add_argument('--audit', action='store_true')
+    run_syscalls_parser.set_defaults(func=run_syscall_scenario)
+    scenario_parser = subparsers.add_parser('run-scenario', help=argparse.SUPPRESS)
+    scenario_parser.add_argument('--root', required=True)
+    scenario_parser.add_argument('--jobs', type=int, default=1)
+    scenario_parser.add_argument('--fix', action='store_true')
+    scenario_parser.add_argument('--cache-file')
+    scenario_parser.set_defaults(func=run_scenario)
+    args = parser.parse_args()
+    logging.basicConfig(format="[%(levelname)s] %(message)s", level=logging.ERROR)
+    args.func(args)
@@ -2,7 +2,7 @@
 #
 # MIT License
 #
-# (C) Copyright 2021-2022 Hewlett Packard Enterprise Development LP
+# (C) Copyright 2021-2022, 2026 Hewlett Packard Enterprise Development LP
 #
 # Permission is hereby granted, free of charge, to any person obtaining a
 # copy of this software and associated documentation files (the "Software"),
@@ -28,7 +28,13 @@ import license_check
 import sys
 import logging
 import tempfile
+import subprocess
 import os
+import shutil
+import threading
+import socket
+import json
+import time
 
 class LicenseCheckTest(unittest.TestCase):
     def testExcludeFolder(self):
@@ -46,6 +52,661 @@ class LicenseCheckTest(unittest.TestCase):
         result = checker.check(["tests/templates/go_template_no_license.yaml", "tests/templates/go_template_one_liner.yaml"])
         self.assertEqual(result, [])
 
+    def testFnmatchSetSameAsFnmatch(self):
+        patterns = ["vendor", "*/vendor", "*.md", "*.tar.gz", ".github/CODEOWNERS", "*/templates/*.yaml", "Dockerfile*", "a?c", "[ab]*", "*"]
+        paths = ["vendor", "a/vendor", "vendor/x", "README.md", "docs/x.md", "x.tar.gz", ".github/CODEOWNERS", "b/templates/x.yaml",
+            "Dockerfile.dev", "abc", "bcd", "md", ".md", "x"]
+        for count in range(1, len(patterns) + 1):
+            matcher = license_check.FnmatchSet(patterns[:count])
+            for path in paths:
+                expected = next((i for i, p in enumerate(patterns[:count]) if license_check.fnmatch.fnmatch(path, p)), None)
+                self.assertEqual(matcher.first_match(path), expected, "%s against %s" % (path, patterns[:count]))
+
+    def testFileTypeDispatchSameAsFnmatch(self):
+        checker = license_check.LicenseCheck()
+        file_types = checker.config["file_types"]
+        paths = ["LICENSE", "a/LICENSE", "Makefile", "x/Makefile.inc", "Jenkinsfile", "a.b/c", "noext", "a/b/c.d/e.go", ".yaml"]
+        for pattern in file_types:
+            for fill in ["", "x", "a/b", "templates/x"]:
+                paths.append(pattern.replace("*", fill))
+                paths.append("dir/" + pattern.replace("*", fill))
+        for path in paths:
+            expected = next((file_types[p] for p in file_types if license_check.fnmatch.fnmatch(path, p)), None)
+            self.assertIs(checker.get_file_type_def(path), expected, path)
+
+    def testLicenseNeedles(self):
+        checker = license_check.LicenseCheck()
+        self.assertEqual(checker.license_needles, ["Copyright"])
+        self.assertEqual(checker.find_license_needles(["Copyright [year] [owner]", "Licensed to [owner]"]), ["Copyright", "Licensed to"])
+        self.assertEqual(checker.find_license_needles(["Copyright [year] [owner]", "[year] [owner]"]), [])
+        with patch.object(checker, "search_pattern", side_effect=AssertionError("pattern applied")):
+            result = checker.check_file("tests/no_license.sh")
+        self.assertEqual(result.code, 1)
+        self.assertRegex(result.message, "^License is not detected:")
+
+    def testCombinedPatternSameAsChain(self):
+        checker = license_check.LicenseCheck(end_year=2022)
+        contents = []
+        for dirname, subdirs, filenames in os.walk("tests"):
+            for filename in filenames:
+                file_type_def = checker.get_file_type_def(os.path.join(dirname, filename))
+                if file_type_def:
+                    content = checker.decode_header(checker.read_header(os.path.join(dirname, filename), file_type_def))
+                    contents += [(file_type_def, content), (file_type_def, "#!/bin/sh\n" + content), (file_type_def, content[40:])]
+        for file_type_def, content in contents + [({"type": "shell_or_python"}, "#!/bin/sh\n# Copyright 2020 Somebody\n")]:
+            role, result = checker.match_header(file_type_def, content)
+            chain_role, chain_result = checker.match_header_chain(file_type_def, content)
+            self.assertEqual((role, result.groupdict()), (chain_role, chain_result.groupdict()), content)
+
+    def testParserEngineSameAsRegex(self):
+        for end_year in [2020, 2022]:
+            regex_checker = license_check.LicenseCheck(end_year=end_year)
+            parser_checker = license_check.LicenseCheck(end_year=end_year, engine="parser")
+            # Make sure both engines are applied to all files, including ones without license
+            regex_checker.license_needles = parser_checker.license_needles = []
+            tempdir = tempfile.mkdtemp()
+            for dirname, subdirs, filenames in os.walk("tests"):
+                for filename in filenames:
+                    filename = os.path.join(dirname, filename)
+                    regex_result = regex_checker.check_file(filename)
+                    parser_result = parser_checker.check_file(filename)
+                    self.assertEqual((parser_result.code, parser_result.message), (regex_result.code, regex_result.message))
+                    if regex_result.matcher:
+                        self.assertEqual(parser_result.matcher.groupdict(), regex_result.matcher.groupdict(), filename)
+                    os.makedirs(os.path.join(tempdir, "regex", dirname), exist_ok=True)
+                    os.makedirs(os.path.join(tempdir, "parser", dirname), exist_ok=True)
+                    regex_checker.check_file(filename, fix=True, outfile=os.path.join(tempdir, "regex", filename))
+                    parser_checker.check_file(filename, fix=True, outfile=os.path.join(tempdir, "parser", filename))
+                    if os.path.exists(os.path.join(tempdir, "regex", filename)):
+                        with open(os.path.join(tempdir, "regex", filename)) as f1, open(os.path.join(tempdir, "parser", filename)) as f2:
+                            self.assertEqual(f2.read(), f1.read(), filename)
+            shutil.rmtree(tempdir)
+
+    def testParallelCheckSameAsSequential(self):
+        sequential = license_check.LicenseCheck(add_exclude=[], end_year=2020).check("tests")
+        parallel = license_check.LicenseCheck(add_exclude=[], end_year=2020, jobs=2).check("tests")
+        self.assertEqual(len(parallel), len(sequential))
+        self.assertEqual([(r.code, r.message) for r in parallel], [(r.code, r.message) for r in sequential])
+
+    def testReadAheadSameAsSequential(self):
+        sequential = license_check.LicenseCheck(add_exclude=[], end_year=2020).check("tests")
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        # Number of reads in flight, and the maximum of it
+        in_flight = [0, 0]
+        lock = threading.Lock()
+        read_header = license_check.LicenseCheck.read_header
+        def slow_read_header(checker, *args):
+            # Simulates file system with high latency
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.002)
+            with lock:
+                in_flight[0] -= 1
+            return read_header(checker, *args)
+        with patch.object(license_check.LicenseCheck, "read_header", slow_read_header):
+            for jobs in [1, 2]:
+                for cache in [False, True]:
+                    checker = license_check.LicenseCheck(add_exclude=[], end_year=2020, io_depth=4, jobs=jobs, stats=True,
+                        cache=cache, cache_file=tempdir + "/.license_check.cache")
+                    results = checker.check("tests")
+                    self.assertEqual([(r.code, r.message) for r in results], [(r.code, r.message) for r in sequential])
+        self.assertGreater(in_flight[1], 1)
+        self.assertLessEqual(in_flight[1], 4)
+
+    def testResultsDontKeepHeaders(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        with open("tests/valid_old_year.sh") as f:
+            content = f.read() + "echo line\n" * 400
+        for i in range(5000):
+            with open(os.path.join(tempdir, "file%d.sh" % i), "w") as f:
+                f.write(content)
+        # Peak RSS is measured in a separate process, after patterns are compiled by the first check
+        script = "\n".join([
+            "import resource, sys",
+            "sys.path[0] = sys.argv[2]",
+            "import license_check",
+            "checker = license_check.LicenseCheck(cache=False, end_year=2020)",
+            "checker.check(sys.argv[1] + '/file0.sh')",
+            "before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss",
+            "results = checker.check(sys.argv[1])",
+            "print(len(results), (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024 // len(results))",
+        ])
+        output = subprocess.run([sys.executable, "-c", script, tempdir, os.path.dirname(os.path.abspath(license_check.__file__))],
+            check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf-8").stdout.split()
+        self.assertEqual(int(output[0]), 5000)
+        # Header window alone is over 1 KB
+        self.assertLess(int(output[1]), 1024)
+        checker = license_check.LicenseCheck(cache=False, end_year=2020)
+        results = checker.check(tempdir)
+        self.assertEqual(results[0].matcher.group("end_year"), "2020")
+        self.assertEqual(checker.summary.score(), (5000, 5000))
+        self.assertEqual(checker.summary.report()["directories"], {tempdir: {"up_to_date": 5000}})
+
+    def testResultCache(self):
+        tempdir = tempfile.mkdtemp()
+        cache_file = tempdir + "/.license_check.cache"
+        checker = license_check.LicenseCheck(add_exclude=[], end_year=2020, cache=True, cache_file=cache_file)
+        cold = checker.check("tests")
+        checker = license_check.LicenseCheck(add_exclude=[], end_year=2020, cache=True, cache_file=cache_file)
+        with patch.object(checker, "check_file", side_effect=AssertionError("cache miss")):
+            warm = checker.check("tests")
+        self.assertEqual([(r.code, r.message) for r in warm], [(r.code, r.message) for r in cold])
+        # Cache is discarded, once configuration affecting results changes
+        checker = license_check.LicenseCheck(add_exclude=[], end_year=2021, cache=True, cache_file=cache_file)
+        self.assertEqual(checker.result_cache.entries, {})
+        # Configuration is cached next to results, not in current directory
+        self.assertTrue(os.path.exists(os.path.join(tempdir, checker.config_cache_name)))
+        self.assertFalse(os.path.exists(checker.config_cache_name))
+        shutil.rmtree(tempdir)
+        # Cached status doesn't depend on file name, even if it appears in message text
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tempdir)
+        with open(".license_check.yaml", "w") as f:
+            f.write("file_types:\n  License:\n    type: plain\n")
+        with open("License", "w") as f:
+            f.write("text\n")
+        cold = license_check.LicenseCheck(end_year=2020, cache=True).check("License")
+        checker = license_check.LicenseCheck(end_year=2020, cache=True)
+        with patch.object(checker, "check_file", side_effect=AssertionError("cache miss")):
+            warm = checker.check("License")
+        self.assertEqual([(r.status, r.message) for r in warm], [(r.status, r.message) for r in cold])
+        self.assertEqual(cold[0].status, license_check.CheckStatus.NOT_DETECTED)
+
+    def testCacheFilesNotChecked(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        shutil.copytree("tests", os.path.join(tempdir, "tests"))
+        command = [sys.executable, os.path.abspath("license_check.py"), "--end-year", "2020"]
+        scores = []
+        # Cache files are written into scanned folder by the first run, and must not change score of the next ones
+        for args in [["--no-cache"], [], []]:
+            run = subprocess.run(command + args, cwd=tempdir, capture_output=True, text=True)
+            scores.append([line for line in run.stderr.splitlines() if "License headers score" in line])
+            self.assertNotIn("not recognized: ./.license_check", run.stderr)
+        self.assertTrue(os.path.exists(os.path.join(tempdir, ".license_check.cache")))
+        self.assertEqual(len(scores[0]), 1)
+        self.assertEqual(scores, [scores[0]] * 3)
+
+    def testIterCheckMaxFailures(self):
+        checker = license_check.LicenseCheck(add_exclude=[], end_year=2020)
+        all_results = checker.check("tests")
+        failures = [r for r in all_results if r.code > 0]
+        self.assertGreater(len(failures), 1)
+        results = list(checker.iter_check("tests", max_failures=1))
+        self.assertEqual([r.code for r in results[:-1]], [0] * (len(results) - 1))
+        self.assertEqual(results[-1].message, failures[0].message)
+        results = list(checker.iter_check("tests", max_failures=2))
+        self.assertEqual(results[-1].message, failures[1].message)
+
+    def testGitTargets(self):
+        repo = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(repo)
+        git = lambda *args: subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com"] + list(args),
+            check=True, stdout=subprocess.DEVNULL)
+        git("init", "-q")
+        for name in ["a.py", "b.sh", "excluded/c.py", "sub/d.go", "sub/removed.py"]:
+            os.makedirs(os.path.dirname(name) or ".", exist_ok=True)
+            with open(name, "w") as f:
+                f.write("print()\n")
+        git("add", ".")
+        git("commit", "-q", "-m", "initial")
+        os.remove("sub/removed.py")
+        with open("untracked.py", "w") as f:
+            f.write("print()\n")
+        with open("b.sh", "a") as f:
+            f.write("echo\n")
+        with open("sub/new.go", "w") as f:
+            f.write("package main\n")
+        git("add", "sub/new.go")
+        checker = license_check.LicenseCheck(add_exclude=["excluded"], git=True, cache=False)
+        self.assertEqual(list(checker.iter_targets(".")), ["a.py", "b.sh", "sub/d.go", "sub/new.go"])
+        self.assertEqual(list(checker.iter_targets("sub")), ["sub/d.go", "sub/new.go"])
+        checker = license_check.LicenseCheck(add_exclude=["excluded"], changed_since="HEAD", cache=False)
+        self.assertEqual(list(checker.iter_targets(".")), ["b.sh", "sub/new.go"])
+        checker = license_check.LicenseCheck(changed_since="no-such-ref", cache=False)
+        self.assertRaises(ValueError, list, checker.iter_targets("."))
+
+    def testStagedContent(self):
+        repo = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        with open("tests/valid_old_year.sh") as f:
+            valid = f.read()
+        os.chdir(repo)
+        git = lambda *args: subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com"] + list(args),
+            check=True, stdout=subprocess.PIPE, encoding="utf-8").stdout
+        git("init", "-q")
+        for name in ["committed.sh", "staged_valid.sh", "staged_invalid.sh", "partially_staged.sh"]:
+            with open(name, "w") as f:
+                f.write("echo\n")
+        git("add", ".")
+        git("commit", "-q", "-m", "initial")
+        # Index content differs from working tree: result must follow the index
+        for name, staged, unstaged in [("staged_valid.sh", valid, "echo\n"), ("staged_invalid.sh", "echo 1\n", valid),
+                ("partially_staged.sh", "echo 2\n", "echo 3\n"), ("new.sh", "echo 4\n", None),
+                ("large.sh", "# Copyright 2020 Someone\n" + "echo hello\n" * 2000, None)]:
+            with open(name, "w") as f:
+                f.write(staged)
+            git("add", name)
+            if unstaged is not None:
+                with open(name, "w") as f:
+                    f.write(unstaged)
+        checker = license_check.LicenseCheck(staged=True, end_year=2020, cache=False)
+        results = {r.message.split(": ")[-1]: r.code for r in checker.check(".")}
+        self.assertEqual(results, {"large.sh": 1, "new.sh": 1, "partially_staged.sh": 1, "staged_invalid.sh": 1, "staged_valid.sh": 0})
+        self.assertIsNone(checker.blob_reader.process)
+        results = {r.message.split(": ")[-1]: r.code for r in license_check.LicenseCheck(staged=True, end_year=2020, cache=False, jobs=2).check(".")}
+        self.assertEqual(results, {"large.sh": 1, "new.sh": 1, "partially_staged.sh": 1, "staged_invalid.sh": 1, "staged_valid.sh": 0})
+        # Files without unstaged changes are fixed and staged again, others are left as they are
+        checker = license_check.LicenseCheck(staged=True, end_year=2020, cache=False)
+        checker.check(".", fix=True)
+        self.assertTrue(git("show", ":new.sh").startswith("#\n# MIT License\n"))
+        self.assertEqual(git("diff", "--name-only"), "partially_staged.sh\nstaged_invalid.sh\nstaged_valid.sh\n")
+        self.assertEqual(git("show", ":partially_staged.sh"), "echo 2\n")
+        with open("partially_staged.sh") as f:
+            self.assertEqual(f.read(), "echo 3\n")
+
+    def testRespectGitignoreSameAsGit(self):
+        repo = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(repo)
+        subprocess.run(["git", "init", "-q"], check=True)
+        with open(".gitignore", "w") as f:
+            f.write("*.log\n!important.log\n/build/\nnode_modules\ndocs/**/c\n\\#hash.py\nsub/**/er/\n[a-c]?.py\ntrail.py   \n# comment\n")
+        os.mkdir("src")
+        with open("src/.gitignore", "w") as f:
+            f.write("*.go\n!keep.go\n")
+        for name in ["build/x/a.py", "src/build/b.py", "docs/a/b/c/x.py", "docs/a/y.py", "node_modules/p/i.js", "logs/a.log",
+                "logs/important.log", "sub/deep/er/z.py", "#hash.py", "ab.py", "abc.py", "trail.py", "src/m.go", "src/keep.go", "x.py"]:
+            os.makedirs(os.path.dirname(name) or ".", exist_ok=True)
+            with open(name, "w") as f:
+                f.write("\n")
+        expected = subprocess.run(["git", "ls-files", "-z", "--others", "--exclude-standard"], check=True, stdout=subprocess.PIPE,
+            universal_newlines=True).stdout.split("\0")[:-1]
+        checker = license_check.LicenseCheck(respect_gitignore=True, exclude=[".git"], add_exclude=[], cache=False)
+        self.assertEqual(sorted(os.path.relpath(f) for f in checker.iter_targets(".")), sorted(expected))
+        # .gitignore files in parent folders of scan target apply as well
+        os.chdir("src")
+        checker = license_check.LicenseCheck(respect_gitignore=True, exclude=[".git"], add_exclude=[], cache=False)
+        self.assertEqual(sorted(checker.iter_targets(".")), ["./.gitignore", "./build/b.py", "./keep.go"])
+
+    def testWalkerUsesDirectoryEntries(self):
+        checker = license_check.LicenseCheck(add_exclude=[], end_year=2020, cache=False)
+        with patch("os.stat", wraps=os.stat) as stat, patch("os.lstat", wraps=os.lstat) as lstat, \
+                patch("os.path.relpath", wraps=os.path.relpath) as relpath:
+            results = checker.check(["tests", "tests/valid_old_year.java"])
+        self.assertEqual(len(results), 22)
+        # Only explicitly provided targets are examined, not each file found while walking
+        self.assertEqual(stat.call_count, 2)
+        self.assertEqual(lstat.call_count, 0)
+        self.assertEqual(relpath.call_count, 2)
+        self.assertIn("tests/valid_old_year.java", [r.message.split(": ")[-1] for r in results])
+
+    def testFixStreamsBodyAndReplacesAtomically(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        filename = os.path.join(tempdir, "script.sh")
+        with open("tests/valid_old_year.sh", "rb") as f:
+            header = f.read().replace(b"\n", b"\r\n")
+        body = b"echo \xff\xfe not utf-8\r\n" + b"x" * 50000 + b"\nend\n"
+        with open(filename, "wb") as f:
+            f.write(header + body)
+        os.chmod(filename, 0o751)
+        checker = license_check.LicenseCheck(end_year=2022)
+        # Failure while copying the rest of the file leaves original file and no temporary files behind
+        with patch.object(checker, "copy_file_tail", side_effect=OSError("disk full")):
+            self.assertRaises(OSError, checker.check_file, filename, fix=True)
+        self.assertEqual(os.listdir(tempdir), ["script.sh"])
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), header + body)
+        checker.check_file(filename, fix=True)
+        with open(filename, "rb") as f:
+            content = f.read()
+        self.assertIn(b"(C) Copyright 2020, 2022 Hewlett Packard Enterprise Development LP\n", content)
+        # Rest of the file is copied as is, including line endings and undecodable bytes
+        self.assertTrue(content.endswith(b"#\nset -ex\r\necho \"Hello World!\"" + body))
+        self.assertEqual(os.stat(filename).st_mode & 0o777, 0o751)
+        self.assertEqual(checker.check_file(filename).code, 0)
+
+    def testDiffAndApply(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        for name in ["valid_old_year.sh", "no_license.java", "one_liner.xml", "valid_old_year.xml"]:
+            shutil.copy("tests/" + name, tempdir)
+        with open(os.path.join(tempdir, "crlf.sh"), "wb") as f:
+            f.write(b"#!/bin/bash\r\necho no newline")
+        fixed = tempdir + ".fixed"
+        shutil.copytree(tempdir, fixed)
+        self.addCleanup(shutil.rmtree, fixed)
+        os.chdir(tempdir)
+        original = {name: open(name, "rb").read() for name in os.listdir(".") if os.path.isfile(name)}
+        checker = license_check.LicenseCheck(end_year=2022, cache=False, diff=True)
+        patches = [r.patch for r in checker.iter_check(["."], fix=True) if r.patch]
+        self.assertEqual(len(patches), 5)
+        # Nothing is changed in diff mode
+        self.assertEqual({name: open(name, "rb").read() for name in original}, original)
+        self.assertIn("--- a/valid_old_year.sh\n+++ b/valid_old_year.sh\n", "".join(patches))
+        self.assertIn("+# (C) Copyright 2020, 2022 Hewlett Packard Enterprise Development LP\n", "".join(patches))
+        os.remove("one_liner.xml")
+        with open("no_license.java", "a") as f:
+            f.write("// appended body is not covered by patch\n")
+        with open("valid_old_year.xml", "wb") as f:
+            f.write(original["valid_old_year.xml"].replace(b"2020", b"2021"))
+        applier = license_check.LicenseCheck(end_year=2022, cache=False)
+        # Files which were removed or have different header are not changed
+        self.assertEqual(applier.apply_patch("".join(patches).splitlines(True)), 2)
+        os.chdir(fixed)
+        license_check.LicenseCheck(end_year=2022, cache=False).check(".", fix=True)
+        for name in ["valid_old_year.sh", "crlf.sh"]:
+            with open(os.path.join(tempdir, name), "rb") as f1, open(name, "rb") as f2:
+                self.assertEqual(f1.read(), f2.read())
+        with open(os.path.join(tempdir, "no_license.java")) as f1, open("no_license.java") as f2:
+            self.assertEqual(f1.read(), f2.read() + "// appended body is not covered by patch\n")
+
+    def testBinaryAndEncodingSniffing(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        with open("tests/valid_old_year.sh", "rb") as f:
+            header = f.read()
+        files = {
+            "blob.yaml": b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR",
+            "utf16.sh": "# MIT License\n".encode("utf-16"),
+            "latin1.sh": header.replace(b"Hello World!", b"Caf\xe9"),
+            "bom.sh": b"\xef\xbb\xbf" + header,
+        }
+        for name, content in files.items():
+            with open(os.path.join(tempdir, name), "wb") as f:
+                f.write(content)
+        checker = license_check.LicenseCheck(end_year=2020)
+        results = {name: checker.check_file(os.path.join(tempdir, name)) for name in files}
+        self.assertEqual(results["blob.yaml"].status, license_check.CheckStatus.BINARY)
+        self.assertRegex(results["blob.yaml"].message, "^Skipping binary file:")
+        self.assertEqual(results["utf16.sh"].status, license_check.CheckStatus.UTF16)
+        self.assertRegex(results["utf16.sh"].message, "^Skipping UTF-16 encoded file:")
+        self.assertEqual(results["latin1.sh"].code, 0)
+        self.assertEqual(results["bom.sh"].code, 0)
+        # Byte order mark stays in front of the file, undecodable bytes are kept
+        checker = license_check.LicenseCheck(end_year=2022)
+        for name in ["latin1.sh", "bom.sh"]:
+            checker.check_file(os.path.join(tempdir, name), fix=True)
+        with open(os.path.join(tempdir, "bom.sh"), "rb") as f:
+            self.assertTrue(f.read().startswith(b"\xef\xbb\xbf#!/bin/bash -l\n#\n# MIT License\n"))
+        with open(os.path.join(tempdir, "latin1.sh"), "rb") as f:
+            self.assertTrue(f.read().endswith(b"echo \"Caf\xe9\""))
+
+    def testAdaptiveHeaderWindow(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        with open("tests/valid_old_year.xml", "rb") as f:
+            header = f.read()
+        with open("tests/valid_old_year.sh", "rb") as f:
+            script = f.read()
+        attributes = b"".join(b'\n    xmlns:ns%d="http://example.com/ns%d"' % (i, i) for i in range(150))
+        files = {
+            "body.java": b"class A {}\n" * 1000,
+            "declaration.xml": header.replace(b"<?xml ", b"<?xml" + attributes + b"\n    ", 1),
+            "blank_lines.sh": script.replace(b"\n", b"\n" * 6000, 1),
+            "stretched.sh": script.replace(b"Development LP\n", b"Development LP\n" + b"\n" * 400, 1),
+        }
+        for name, content in files.items():
+            with open(os.path.join(tempdir, name), "wb") as f:
+                f.write(content)
+        checker = license_check.LicenseCheck(end_year=2020)
+        # Correct and headerless files are read in a window fitting the header only
+        self.assertLess(len(checker.read_header("tests/valid_old_year.java", checker.get_file_type_def("tests/valid_old_year.java"))), 2048)
+        filename = os.path.join(tempdir, "body.java")
+        self.assertLess(len(checker.read_header(filename, checker.get_file_type_def(filename))), 2048)
+        # Header pushed beyond initial window by long preamble is still found, and can be fixed
+        filename = os.path.join(tempdir, "declaration.xml")
+        self.assertGreater(len(files["declaration.xml"]), 4092)
+        self.assertEqual(checker.check_file(filename).code, 0)
+        fixer = license_check.LicenseCheck(end_year=2022)
+        fixer.check_file(filename, fix=True)
+        with open(filename, "rb") as f:
+            content = f.read()
+        self.assertTrue(content.startswith(b"<?xml" + attributes))
+        self.assertEqual(content.count(b"(C) Copyright 2020, 2022 Hewlett Packard Enterprise Development LP\n"), 1)
+        self.assertEqual(fixer.check_file(filename).code, 0)
+        self.assertEqual(checker.check_file(os.path.join(tempdir, "blank_lines.sh")).code, 0)
+        # Header stretched beyond the window by blank lines between template lines is matched as a whole, and not added again
+        filename = os.path.join(tempdir, "stretched.sh")
+        self.assertEqual(checker.check_file(filename).code, 0)
+        fixer.check_file(filename, fix=True)
+        with open(filename, "rb") as f:
+            content = f.read()
+        self.assertEqual(content.count(b"MIT License"), 1)
+        self.assertEqual(content.count(b"(C) Copyright 2020, 2022 Hewlett Packard Enterprise Development LP\n"), 1)
+        self.assertEqual(fixer.check_file(filename).code, 0)
+
+    def testNestedConfigs(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        with open("tests/valid_old_year.sh") as f:
+            valid = f.read()
+        os.chdir(tempdir)
+        nested = "owner: Somebody Else\nadd_exclude: [generated]\nfile_types:\n  '*.tmpl':\n    type: shell_or_python\n"
+        files = {
+            "a.sh": valid,
+            "c.tmpl": "",
+            "generated/x.sh": "echo\n",
+            "sub/.license_check.yaml": nested,
+            "sub/b.sh": valid.replace("Hewlett Packard Enterprise Development LP", "Somebody Else"),
+            "sub/c.tmpl": valid,
+            "sub/generated/y.sh": "echo\n",
+            "sub/deeper/.license_check.yaml": "cache_max_entries: 10\n",
+            "sub/deeper/d.sh": valid,
+            "other/.license_check.yaml": nested,
+            "other/e.sh": "echo\n",
+        }
+        for name, content in files.items():
+            os.makedirs(os.path.dirname(name) or ".", exist_ok=True)
+            with open(name, "w") as f:
+                f.write(content)
+        for jobs in [1, 2]:
+            checker = license_check.LicenseCheck(end_year=2020, cache=False, jobs=jobs)
+            # Nested configuration files are checked like any other YAML file
+            results = {r.message.split(": ")[-1]: r.message.split(": ")[0] for r in checker.check(".")
+                if not r.message.endswith(".license_check.yaml")}
+            self.assertEqual(results, {
+                "./a.sh": "License is up to date",
+                "./c.tmpl": "Filename pattern not recognized",
+                "./generated/x.sh": "License is not detected",
+                "./other/e.sh": "License is not detected",
+                "./sub/b.sh": "License is up to date",
+                "./sub/c.tmpl": "License is detected, but copyright owner is not current",
+                "./sub/deeper/d.sh": "License is detected, but copyright owner is not current",
+            })
+        # Explicit targets and exclusions are scoped the same way
+        self.assertEqual(checker.check(["sub/generated/y.sh"]), [])
+        self.assertEqual(checker.check(["sub/b.sh"])[0].code, 0)
+        # Scopes with the same templates and types share compiled patterns
+        self.assertIs(checker.scopes["sub/deeper"].license_pattern_by_type, checker.scopes["sub"].license_pattern_by_type)
+        self.assertIs(checker.scopes["other"].license_pattern_by_type, checker.scopes["sub"].license_pattern_by_type)
+        self.assertIsNot(checker.scopes["sub"].license_pattern_by_type, checker.license_pattern_by_type)
+        # File type patterns are matched relative to the folder of configuration file declaring them
+        for relpath, file_type in [("sub/LICENSE", None), ("sub/templates/x.yaml", "go_template"), ("sub/x.tmpl", "shell_or_python"),
+                ("other/x.tmpl", "shell_or_python"), ("sub/deeper/x.tmpl", "shell_or_python"), ("x.tmpl", None),
+                ("LICENSE", "plain")]:
+            file_type_def = checker.config_scope(os.path.dirname(relpath)).get_file_type_def(relpath, relpath)
+            self.assertEqual(file_type_def["type"] if file_type_def else None, file_type, relpath)
+
+    def testConfigCache(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        filename = os.path.abspath("tests/valid_old_year.java")
+        os.chdir(tempdir)
+        cold = license_check.LicenseCheck(cache=True, end_year=2020)
+        self.assertTrue(os.path.exists(cold.config_cache_file))
+        # Patterns are built and compiled on first use of a file type only, combined pattern only if main one doesn't match
+        self.assertEqual(cold.combined_sources, {})
+        self.assertEqual(cold.combined_pattern_by_type, {})
+        self.assertEqual(list(cold.check(filename))[0].code, 0)
+        self.assertEqual(list(cold.combined_sources), ["java_block|java_inline"])
+        self.assertEqual(list(cold.combined_pattern_by_type), [("java_block", "java_inline", 0)])
+        with patch.object(license_check.LicenseCheck, "read_config") as read_config:
+            warm = license_check.LicenseCheck(cache=True, end_year=2020)
+            self.assertEqual(read_config.call_count, 0)
+        self.assertEqual(warm.config, cold.config)
+        self.assertEqual(warm.combined_sources, cold.combined_sources)
+        self.assertEqual(warm.check_file(filename).code, 0)
+        # Changed arguments or configuration file content make a new entry
+        with patch.object(license_check.LicenseCheck, "read_config", wraps=warm.read_config) as read_config:
+            self.assertEqual(license_check.LicenseCheck(cache=True, end_year=2022).check_file(filename).code, 1)
+            with open(".license_check.yaml", "w") as f:
+                f.write("owner: Somebody Else\n")
+            self.assertEqual(license_check.LicenseCheck(cache=True, end_year=2020).check_file(filename).code, 1)
+            self.assertEqual(read_config.call_count, 3)
+
+    def testShardAndMerge(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        shutil.copytree("tests", os.path.join(tempdir, "tests"))
+        command = [sys.executable, os.path.abspath("license_check.py"), "--no-cache", "--end-year", "2022"]
+        full = subprocess.run(command + ["tests"], cwd=tempdir, capture_output=True, text=True)
+        self.assertEqual(full.returncode, 1)
+        # Shards are run as separate processes, like CI jobs on different nodes
+        for index in [1, 2, 3]:
+            subprocess.run(command + ["--shard", "%d/3" % index, "--results-out", "shard%d.json" % index, "tests"], cwd=tempdir, capture_output=True)
+        merged = subprocess.run(command + ["--merge", "shard3.json", "shard1.json", "shard2.json"], cwd=tempdir, capture_output=True, text=True)
+        self.assertEqual(merged.returncode, full.returncode)
+        self.assertEqual(sorted(line for line in merged.stderr.splitlines() if "WARNING" in line),
+            sorted(line for line in full.stderr.splitlines() if "WARNING" in line))
+        score = [line for line in full.stderr.splitlines() if "License headers score" in line]
+        self.assertEqual(len(score), 1)
+        self.assertIn(score[0], merged.stderr.splitlines())
+        # Shards are disjoint and cover all files
+        sizes = []
+        for index in [1, 2, 3]:
+            with open(os.path.join(tempdir, "shard%d.json" % index)) as f:
+                summary = license_check.ResultSummary()
+                summary.merge_report(json.load(f)["summary"])
+                sizes.append(sum(sum(counts.values()) for counts in summary.by_type.values()))
+        self.assertEqual(sum(sizes), len([line for line in full.stderr.splitlines() if "tests/" in line and "Excluding" not in line]))
+        self.assertTrue(all(sizes), sizes)
+        merged = subprocess.run(command + ["--merge", "shard1.json", "shard2.json"], cwd=tempdir, capture_output=True, text=True)
+        self.assertEqual(merged.returncode, 2)
+        self.assertIn("Missing results of shard(s) 3/3", merged.stderr)
+
+    def testWatchChecksChangedFiles(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        valid = os.path.abspath("tests/valid_old_year.java")
+        for inotify in [False, True]:
+            tempdir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, tempdir)
+            shutil.copy(valid, tempdir)
+            os.chdir(tempdir)
+            watch = license_check.LicenseWatch(dict(cache=False, end_year=2020), os.path.curdir, poll_interval=0, inotify=inotify)
+            watch.start()
+            self.assertEqual(len(watch.results), 1)
+
+            def changed():
+                events = watch.watcher.events(1)
+                self.assertTrue(events)
+                watch.handle(events)
+                return {path: result.status for path, result in watch.results.items()}
+
+            with open("no_license.java", "w") as f:
+                f.write("class A {}\n")
+            self.assertEqual(changed()["./no_license.java"], license_check.CheckStatus.NOT_DETECTED)
+            os.makedirs("sub")
+            shutil.copy(valid, "sub/a.java")
+            self.assertEqual(changed().get("./sub/a.java"), license_check.CheckStatus.UP_TO_DATE, inotify)
+            os.remove("no_license.java")
+            self.assertNotIn("./no_license.java", changed())
+            # Live summary is the same as of a full scan
+            scan = license_check.LicenseCheck(cache=False, end_year=2020)
+            scan.check(os.path.curdir)
+            self.assertEqual(watch.license_check.summary.report(), scan.summary.report())
+            with open(".license_check.yaml", "w") as f:
+                f.write("exclude:\n  - \"sub/**\"\n")
+            self.assertNotIn("./sub/a.java", changed())
+            watch.watcher.close()
+
+    def testServeAndConnect(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        script = os.path.abspath("license_check.py")
+        workdir = os.path.join(tempdir, "work")
+        os.mkdir(workdir)
+        shutil.copy("tests/valid_old_year.java", workdir)
+        # Relative socket path keeps referring to the same socket, while requests are served in client working directory
+        os.chdir(tempdir)
+        socket_path = os.path.join(tempdir, "server.sock")
+        server = license_check.LicenseCheckServer("server.sock", license_check.build_arg_parser())
+        server.request_timeout = 0.1
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        client = [sys.executable, script, "--connect", socket_path, "--no-cache", "--end-year", "2020", "valid_old_year.java"]
+        try:
+            # Client which connects and sends nothing doesn't block the server
+            silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            silent.connect(socket_path)
+            self.addCleanup(silent.close)
+            # Bad arguments and modes which can't be served are rejected, without shutting down the server
+            for argv, expected in [(["--bogus"], "unrecognized arguments: --bogus"), (["--watch"], "can't run --watch")]:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                    conn.connect(socket_path)
+                    license_check.LicenseCheckServer.send(conn, {"cwd": workdir, "argv": argv, "environ": {}})
+                    replies = [json.loads(line) for line in conn.makefile("rb")]
+                self.assertEqual(replies[-1], {"exit": 2})
+                self.assertIn(expected, json.dumps(replies[:-1]))
+            run = subprocess.run(client, cwd=workdir, capture_output=True, text=True)
+            self.assertEqual(run.returncode, 0)
+            self.assertIn("[INFO] License is up to date: valid_old_year.java", run.stderr)
+            self.assertIn("Parsing config file", run.stderr)
+            # Checker is kept warm between runs, until configuration file changes
+            run = subprocess.run(client, cwd=workdir, capture_output=True, text=True)
+            self.assertEqual(run.returncode, 0)
+            self.assertNotIn("Parsing config file", run.stderr)
+            with open(os.path.join(workdir, ".license_check.yaml"), "w") as f:
+                f.write("owner: Somebody Else\n")
+            run = subprocess.run(client, cwd=workdir, capture_output=True, text=True)
+            self.assertEqual(run.returncode, 1)
+            self.assertIn("Configuration has changed, reloading", run.stderr)
+            self.assertIn("copyright owner is not current", run.stderr)
+            self.assertEqual(len(server.checkers), 1)
+            self.assertEqual(os.getcwd(), tempdir)
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertFalse(os.path.exists(socket_path))
+        # Without server, client checks files itself
+        run = subprocess.run(client, cwd=workdir, capture_output=True, text=True)
+        self.assertEqual(run.returncode, 1)
+        self.assertIn("License check server is not available", run.stderr)
+
+    def testScanStats(self):
+        checker = license_check.LicenseCheck(add_exclude=[], end_year=2020, stats=True)
+        self.assertIsNone(license_check.LicenseCheck().stats)
+        results = checker.check("tests")
+        parallel = license_check.LicenseCheck(add_exclude=[], end_year=2020, stats=True, jobs=2)
+        parallel.check("tests")
+        for stats in [checker.stats, parallel.stats]:
+            report = stats.report()
+            self.assertEqual(report["files"], len(results))
+            self.assertEqual(sum(report["file_types"].values()), len([r for r in results if r.code != 0 or "not recognized" not in r.message]))
+            self.assertGreater(report["counters"]["main pattern attempts"], 0)
+            self.assertGreater(report["phases"]["read"], 0)
+            self.assertLessEqual(len(report["slowest_files"]), 10)
+        self.assertIn("Slowest files:", checker.stats.format_report())
+
     def testValidYaml(self):
         checker = license_check.LicenseCheck(end_year=2020)
         result = checker.check_file("tests/valid_old_year.yaml")